@@ -1,6 +1,7 @@
-import csv, os, re
+import os, re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import subprocess
 from sqlalchemy import func
 
 
@@ -14,16 +15,17 @@ from wtforms import StringField, SubmitField
 from werkzeug.security import generate_password_hash, check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
 
-from flair.data import Sentence
-from flair.models import SequenceTagger
-model_ner = SequenceTagger.load('static/model/ner-model-roberta-aug-mr-jean-baptiste.pt')
+from model_registry import configure, get_ner_model, get_pattern_features, get_ranker, model_fingerprint, model_stats, model_status, is_ready, start_warmup
+from ner_inference import tag_stories
+from ranklib import save_features
+from dfd_graph import DfdGraph
 
-from model import db, User, Project, Stories, StoryQuality, Entities, Dfd, Dfd_triple, Dfd_triple_group, RequirementGroup, Requirements, RequirementGroupsPatterns, RequirementsPatterns, PrivacyPattern, LogAction, PatternCategory
+from model import db, create_cache_indexes, User, Project, Stories, StoryQuality, Entities, EmbeddingCache, LtrFeatureBlock, PatternRecommendation, Dfd, Dfd_triple, Dfd_triple_group, RequirementGroup, Requirements, RequirementGroupsPatterns, RequirementsPatterns, PrivacyPattern, LogAction, PatternCategory
 
 
-from feature_engineering import PrivacyPatternFeatures
-pp = PrivacyPatternFeatures()
-pattern_dict = pp.get_lookup_patterns()
+# the models are loaded lazily, see model_registry and the warm-up below
+from pattern_catalog import get_lookup_patterns
+pattern_dict = get_lookup_patterns()
 
 # faster debug
 # model_disclosure = TextClassifier.load('static/model/disclosure-model.pt')
@@ -39,6 +41,23 @@ app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///test.db'
 app.config['SECRET_KEY'] = "sdfawfeaw2b9a5d0208a72aasdqw1231234feba25506"
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['BOOTSTRAP_SERVE_LOCAL'] = True
+app.config['NER_BATCH_SIZE'] = 32
+app.config['SPACY_BATCH_SIZE'] = 64
+app.config['SPACY_N_PROCESS'] = 1
+# worker processes generating the per story DFDs of /gen_dfd, 1 generates them in the web process
+app.config['DFD_WORKERS'] = 1
+# keep the robustness diagram (_robust.txt and _robust.png) next to every DFD
+app.config['DFD_KEEP_ROBUST_FILES'] = True
+# keep the drawio CSV export (.csv) of every DFD, the triples are saved from the DFD graph
+app.config['DFD_KEEP_CSV'] = True
+# int8 CPU inference for the NER tagger and sentence encoders, see quantization_benchmark.py
+app.config['QUANTIZED_INFERENCE'] = False
+# LTR features: full (both encoders), minilm (no stackoverflow_mpnet) or lexical (no encoder), see ltr_benchmark.py
+app.config['LTR_FEATURE_SET'] = "full"
+# number of ranked patterns stored for every requirement
+app.config['PATTERN_RECOMMENDATION_DEPTH'] = 20
+# save the LTR feature tensor of every ranking to LTR_resources/ltr_<project>.npz, for offline RankLib experiments
+app.config['LTR_SAVE_FEATURES'] = False
 
 db.init_app(app)
 Bootstrap(app)
@@ -50,6 +69,18 @@ login_manager = LoginManager()
 login_manager.login_view = "login"
 login_manager.init_app(app)
 
+configure(quantize=app.config['QUANTIZED_INFERENCE'], feature_set=app.config['LTR_FEATURE_SET'])
+
+def init_web_process():
+  # only called by the web process, the DFD worker processes import this module again (as __mp_main__)
+  # create the cache tables and their unique indexes that are missing in existing databases
+  with app.app_context():
+    db.create_all()
+    create_cache_indexes()
+
+  # load the heavy models in the background, login, projects and stories are served meanwhile
+  start_warmup()
+
 
 class LogFilterForm(FlaskForm):
     username = StringField('Username')
@@ -82,6 +113,15 @@ def save_action(action):
 def load_user(user_id):
     return db.session.get(User,int(user_id))
   
+@app.route('/healthz')
+def healthz():
+  return jsonify({'status' : 'ok', 'models' : model_status(), 'stats' : model_stats()})
+
+@app.route('/readyz')
+def readyz():
+  ready = is_ready()
+  return jsonify({'ready' : ready, 'models' : model_status()}), 200 if ready else 503
+
 @app.route('/')
 @login_required
 def index():
@@ -262,6 +302,9 @@ def edit_backlog():
   if request.method == 'POST':
     save_action("edit_backlog")
     story_to_be_updated = Requirements.query.filter_by(id=request.form['pk']).first()
+    if story_to_be_updated.req_text != request.form["value"]:
+      # the ranked patterns were computed from the previous text
+      PatternRecommendation.replace([story_to_be_updated.id], [], [])
     story_to_be_updated.req_text = request.form["value"]
     
     db.session.commit()
@@ -368,44 +411,50 @@ def unvalidate_req_group():
 def show_solution():
   save_action("show_solution")
   req_id = request.form['req_id']
-  project_id = request.form['prj_id']
   
   top = 5
   recommendations = []
-  
-  with open("LTR_resources/ltr_output_{}.txt".format(project_id), "r") as ff:
-    for f in ff:
-      
-      if f.startswith(str(req_id)):
-        top -= 1
-        
-        pattern_title = f.split()[2].replace("docid=","")
-        recommendations.append(pattern_dict[pattern_title])
-        
-      if top == 0:
-        break
+  ranking = "ltr"
 
-  return jsonify({'htmlresponse' : render_template('solution.html', recommendations=recommendations)})
+  # req_id is the qid of the ranking, r<requirement id> or g<requirement group id>
+  qid = req_id if req_id.startswith("g") or req_id.startswith("r") else "r{}".format(req_id)
+  if qid.startswith("g"):
+    ranked = PatternRecommendation.top(requirement_group_id=int(qid[1:]), k=top)
+  else:
+    ranked = PatternRecommendation.top(requirement_id=int(qid[1:]), k=top)
 
-def refresh_ner(story_id, story):
-  Entities.query.filter(Entities.story_id==story_id).delete()
+  for recommendation in ranked:
+    recommendations.append(pattern_dict[recommendation.pattern_key])
 
-  sentence = Sentence(story)
+  if len(ranked) == 0:
+    # not ranked yet: instant top-k from the MiniLM embedding, the LTR ranking is computed in the background
+    requirement = db.session.get(RequirementGroup if qid.startswith("g") else Requirements, int(qid[1:]))
 
-  model_ner.predict(sentence)
-  
+    if requirement is not None:
+      pp = get_pattern_features()
+      order, scores = pp.quick_rank(requirement.req_text, top, embedding_cache=EmbeddingCache)
+      db.session.commit()
+
+      for i in order:
+        recommendations.append(pattern_dict[pp.pattern_titles[i].replace(" ","-")])
+
+      rerank_in_background(qid)
+      ranking = "instant"
+
+  return jsonify({'htmlresponse' : render_template('solution.html', recommendations=recommendations), 'ranking' : ranking})
+
+def store_entities(story_to_be_updated, spans):
+  # entities of one story, the caller is responsible for the commit
+  story = story_to_be_updated.story
   is_disclosure = False
 
-  for entity in sentence.get_spans('ner'):
-    new_entity = Entities(story_id, entity.start_position, entity.end_position, story[entity.start_position:entity.end_position], entity.get_label("ner").value)
-    if entity.get_label("ner").value == "PII" or entity.get_label("ner").value == "Processing":
+  for entity in spans:
+    new_entity = Entities(story_to_be_updated.id, entity.start, entity.end, story[entity.start:entity.end], entity.label)
+    if entity.label == "PII" or entity.label == "Processing":
       is_disclosure = True
 
     db.session.add(new_entity)
 
-
-  story_to_be_updated = Stories.query.filter_by(id=story_id).first()
-
   '''
   Old Flair
 
@@ -436,6 +485,29 @@ def refresh_ner(story_id, story):
   # We change Predus with NER conditions. If PII or processing is present in the history, then it is likely to have disclosure
   story_to_be_updated.disclosure = is_disclosure
 
+def refresh_ner(story_id, story):
+  Entities.query.filter(Entities.story_id==story_id).delete()
+
+  story_to_be_updated = Stories.query.filter_by(id=story_id).first()
+  spans, = tag_stories([story], get_ner_model(), fingerprint=model_fingerprint("ner"))
+
+  store_entities(story_to_be_updated, spans)
+
+  db.session.commit()
+
+def refresh_ner_batch(stories):
+  # tag all the stories in length-sorted mini-batches and save them in one transaction
+  story_ids = [story.id for story in stories]
+
+  # keep the IN clause under the sqlite variable limit
+  for i in range(0, len(story_ids), 500):
+    Entities.query.filter(Entities.story_id.in_(story_ids[i:i + 500])).delete(synchronize_session=False)
+
+  all_spans = tag_stories([story.story for story in stories], get_ner_model(), app.config['NER_BATCH_SIZE'], model_fingerprint("ner"))
+
+  for story, spans in zip(stories, all_spans):
+    store_entities(story, spans)
+
   db.session.commit()
 
 @app.route('/delete_story', methods=('POST', 'DELETE'))
@@ -673,73 +745,38 @@ def gen_ner():
   project_to_be_updated.checked_entity = 1
   project_to_be_updated.checked_disclosure = 1
 
-  for story in stories:
-    refresh_ner(story.id, story.story)
+  refresh_ner_batch(stories)
 
   return jsonify({'success' : 'success'})
 
-def save_dfd_triple(csv_filename, story_id=None, dfd_id=None):
-  with open(csv_filename, 'r') as csvfile:
-    dfdlines = csv.reader(csvfile, delimiter=',')
-    next(dfdlines)
-
-    elements = {}
-    triples = []
-
-    for ent in dfdlines:
-      if ent[-1] != "endArrow=classic":
-        elements[ent[0]] = {}
-        elements[ent[0]]['type'] = ent[-1]
-        elements[ent[0]]['label'] = ent[1]
-      else:
-        if len(triples) == 0:
-          triples.append([ent[3],ent[4]])
-        else:
-          found_pair = False
-          new_triples = []
-          for i, t in enumerate(triples):
-            if ent[3] == t[1]:
-              found_pair = True
-
-              if len(t) == 2:
-                triples[i].append(ent[4])
-              else:
-                new_triples.append([t[0],t[1],ent[4]])
-
-
-          if not found_pair:
-            triples.append([ent[3],ent[4]])
-
-          triples.extend(new_triples)
-
-    # remove duplicates
-    # triples = list(set(map(lambda i: tuple(sorted(i)), triples)))
-
-    for t in triples:
-      if len(t) == 3:
-        if elements[t[2]]['type'] != "data_base":
-          continue
-
-        if story_id:
-          new_triple = Dfd_triple(story_id, elements[t[0]]['label'], elements[t[1]]['label'], elements[t[2]]['label'])
-          db.session.add(new_triple)
-        else:
-          new_triple = Dfd_triple_group(dfd_id, elements[t[0]]['label'], elements[t[1]]['label'], elements[t[2]]['label'])
-          db.session.add(new_triple)
+def save_dfd_graph(graph, story_id=None, dfd_id=None):
+  # one Dfd_triple (story) or Dfd_triple_group (group DFD) per (external entity, process, data store) of the graph, the caller commits
+  for external_entity, process, data_store in graph.triples():
+    if story_id:
+      db.session.add(Dfd_triple(story_id, external_entity, process, data_store))
+    else:
+      db.session.add(Dfd_triple_group(dfd_id, external_entity, process, data_store))
 
-    db.session.commit()
-  
+def save_dfd_triples(folder_path, graphs=None):
+  # graphs are the DfdGraph of the stories generated now, by story id,
+  # the other stories of the folder are read back from their CSV export
+  graphs = dict(graphs or {})
 
-def save_dfd_triples(folder_path):
   for fl in os.listdir(folder_path):
     if not fl.endswith(".csv"):
       continue
 
     story_id = int(fl.split("_")[-1].replace(".csv",""))
 
+    if story_id not in graphs:
+      graphs[story_id] = DfdGraph.from_csv(folder_path + "/{}".format(fl))
+
+  for story_id, graph in graphs.items():
     Dfd_triple.query.filter(Dfd_triple.story_id==story_id).delete()
 
-    save_dfd_triple(folder_path + "/{}".format(fl), story_id=story_id)
+    save_dfd_graph(graph, story_id=story_id)
+
+  db.session.commit()
 
   return True
 
@@ -812,10 +849,20 @@ def gen_dfd():
   stories = Stories.query.filter(Stories.project_id==project_id).all()
 
   dd = StoryDFD(root_dfd_folder +  "/")
+  dd.ner_batch_size = app.config['NER_BATCH_SIZE']
+  dd.nlp_batch_size = app.config['SPACY_BATCH_SIZE']
+  dd.nlp_n_process = app.config['SPACY_N_PROCESS']
+  dd.n_workers = app.config['DFD_WORKERS']
+  dd.keep_robust_files = app.config['DFD_KEEP_ROBUST_FILES']
+  dd.keep_dfd_csv = app.config['DFD_KEEP_CSV']
+  project_name = project.name
   dd.setStories([story.story for story in stories], [story.id for story in stories])
-  dd.processDFDPerStory(project.name)
+  graphs = dd.processDFDPerStory(project_name)
+
+  # with DFD_WORKERS > 1 the session is closed before the workers start, the stories are loaded again
+  stories = Stories.query.filter(Stories.project_id==project_id).all()
 
-  save_dfd_triples(root_dfd_folder + "/" + project.name)
+  save_dfd_triples(root_dfd_folder + "/" + project_name, graphs)
   save_privacy_requirements(stories)
 
   return jsonify({'success' : 'success'})
@@ -858,31 +905,92 @@ def see_backlog(project_id):
   return render_template('privacy_backlog.html', requirements=requirements, requirement_group=requirement_group, req_ner=req_ner, req_group_ner=req_group_ner, project_id=project_id)
 
   
-def generate_features(requirements, title, group=False, req_len=0):
-  lines = []
-  
-  for i, req in enumerate(requirements):
-    print("Generating Features for Story #", req.id)
-    
-    story_key = i + req_len if group  else i
+def generate_features(requirements, requirement_group):
+  # qid of every requirement and group, docid (pattern key) of every pattern, and the (n_qids x n_patterns x 26) feature tensor
+  # features of the texts ranked before are read from LtrFeatureBlock
+  pp = get_pattern_features()
+  docids = [title.replace(" ","-") for title in pp.pattern_titles]
+  qids = ["r{}".format(req.id) for req in requirements] + ["g{}".format(req.id) for req in requirement_group]
+  texts = [req.req_text for req in requirements] + [req.req_text for req in requirement_group]
+
+  features = pp.construct_feature_blocks(texts, cache=LtrFeatureBlock, embedding_cache=EmbeddingCache)
+
+  return qids, docids, features
+
+def store_recommendations(qids, pattern_keys, scores, order):
+  # top ranked patterns of every qid (r<id> or g<id>), in one bulk insert, the caller commits
+  depth = app.config['PATTERN_RECOMMENDATION_DEPTH']
+  requirement_ids, requirement_group_ids, rows = [], [], []
+
+  for qid, query_scores, query_order in zip(qids, scores, order):
+    requirement_id = requirement_group_id = None
+    if qid.startswith("g"):
+      requirement_group_id = int(qid[1:])
+      requirement_group_ids.append(requirement_group_id)
+    else:
+      requirement_id = int(qid[1:])
+      requirement_ids.append(requirement_id)
+
+    for rank, i in enumerate(query_order[:depth]):
+      rows.append({
+        "requirement_id" : requirement_id,
+        "requirement_group_id" : requirement_group_id,
+        "rank" : rank + 1,
+        "pattern_key" : pattern_keys[i],
+        "score" : float(query_scores[i]),
+      })
+
+  PatternRecommendation.replace(requirement_ids, requirement_group_ids, rows)
+
+def rank_requirements(requirements, requirement_group, project_id=None):
+  # LTR ranking of the requirements and groups, stored in PatternRecommendation
+  # only the requirement texts never seen before are encoded and featurized
+  qids, docids, features = generate_features(requirements, requirement_group)
+  db.session.commit()
 
-    features_all = pp.construct_features(req.req_text, story_key)
+  print("Done generating Features!")
 
-    for i_pattern, features in enumerate(features_all):
-      line = ""
-      if group:
-        line += "{} qid:g{}".format(1, req.id) # 1 does not mean anything
-      else:
-        line += "{} qid:r{}".format(1, req.id)
-        
-      for i_feature, val in enumerate(features):
-        line += " {}:{}".format(i_feature+1, val)
+  print("Ranking the Design Patterns...")
 
-      line += " #docid={}".format(title[i_pattern].replace(" ","-"))
+  # RankBoost scores of every (requirement, pattern), computed in-process instead of RankLib
+  ranker = get_ranker()
+  scores = ranker.score(features)
+  order = ranker.rank(scores)
 
-      lines.append(line)
-      
-  return lines
+  if app.config['LTR_SAVE_FEATURES'] and project_id is not None:
+    save_features("LTR_resources/ltr_{}.npz".format(project_id), features, qids, docids)
+
+  store_recommendations(qids, docids, scores, order)
+  db.session.commit()
+
+# qids queued or being re-ranked in the background, a qid is never queued twice
+rerank_jobs = set()
+rerank_lock = threading.Lock()
+# one worker, the re-rankings run one after the other instead of competing for the CPU and the database
+rerank_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+
+def rerank_in_background(qid):
+  # second stage of show_solution: LTR ranking of one requirement (r<id>) or group (g<id>) on the re-ranking worker
+  with rerank_lock:
+    if qid in rerank_jobs:
+      return
+
+    rerank_jobs.add(qid)
+
+  def run():
+    try:
+      with app.app_context():
+        if qid.startswith("g"):
+          rank_requirements([], RequirementGroup.query.filter_by(id=int(qid[1:])).all())
+        else:
+          rank_requirements(Requirements.query.filter_by(id=int(qid[1:])).all(), [])
+    except Exception:
+      app.logger.exception("Re-ranking of %s failed", qid)
+    finally:
+      with rerank_lock:
+        rerank_jobs.discard(qid)
+
+  rerank_executor.submit(run)
 
 @app.route('/gen_pattern_recommendation', methods=['POST'])
 @login_required
@@ -893,39 +1001,7 @@ def gen_pattern_recommendation():
   requirements = Requirements.query.join(Dfd_triple, Dfd_triple.id==Requirements.triple_id).join(Stories, Stories.id==Dfd_triple.story_id).filter(Stories.project_id==project_id, Requirements.valid=="yes").all()
   requirement_group = RequirementGroup.query.join(Dfd_triple_group, Dfd_triple_group.id==RequirementGroup.triple_id).join(Dfd, Dfd.id==Dfd_triple_group.dfd_id).filter(Dfd.project_id==project_id, RequirementGroup.valid=="yes").all()
 
-  X, title, excerpt = pp.get_corpus_pattern()
-
-  
-  all_story = [req.req_text for req in requirements]
-  req_len = len(all_story)
-  all_story += [req.req_text for req in requirement_group]
-  
-  pp.construct_story_embeddings(all_story)
-
-  lines = generate_features(requirements, title)
-  lines += generate_features(requirement_group, title, True, req_len)
-
-  print("Done generating Features!")
-
-  LTR_filename = "LTR_resources/ltr_{}.txt".format(project_id)
-  output_LTR_filename = "LTR_resources/ltr_output_{}.txt".format(project_id)
-  with open(LTR_filename, "w") as f:
-    for l in lines:
-        f.write(l+"\n")
-
-  print("Ranking the Design Patterns...")
-
-  cmd_rerank = "java -jar RankLib-2.18.jar -load LTR_resources/4_RankBoost.model -rank {} -indri {}".format(LTR_filename, output_LTR_filename)
-  print(cmd_rerank)
-  subprocess.run(cmd_rerank)
-
-  top = 5
-  # to do: if we want to process more than one story, we need to separate the qid.
-  # the pattern already sorted in indri
-  pattern_top = []
-  with open(output_LTR_filename, "r") as rr:
-    for r in rr:
-      pattern_top.append(r.split()[2].replace("docid=",""))
+  rank_requirements(requirements, requirement_group, project_id)
 
   return jsonify({'success' : 'success'})
 
@@ -951,13 +1027,19 @@ def gen_group_dfd():
     filename = 's_' + '_'.join(story_ids)
 
     dd = StoryDFD()
-    dd.processDFDFromList(stories, project_name + "Group", filename)
+    dd.ner_batch_size = app.config['NER_BATCH_SIZE']
+    dd.nlp_batch_size = app.config['SPACY_BATCH_SIZE']
+    dd.nlp_n_process = app.config['SPACY_N_PROCESS']
+    dd.keep_robust_files = app.config['DFD_KEEP_ROBUST_FILES']
+    dd.keep_dfd_csv = app.config['DFD_KEEP_CSV']
+    graph = dd.processDFDFromList(stories, project_name + "Group", filename)
 
     new_data = Dfd(story.project_id, '_'.join(story_ids), '###'.join(stories), filename)
     db.session.add(new_data)
     db.session.commit()
 
-    save_dfd_triple(root_dfd_folder + "/" + project_name + "Group/" + filename + ".csv", dfd_id=new_data.id)
+    save_dfd_graph(graph, dfd_id=new_data.id)
+    db.session.commit()
     save_privacy_requirement_group(new_data.id)
   
   return jsonify({'success' : 'success'})
@@ -1091,4 +1173,5 @@ def privacy_backlog():
 
 
 if __name__ == "__main__":
+  init_web_process()
   app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
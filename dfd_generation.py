@@ -1,40 +1,105 @@
 import logging
-logging.basicConfig(filename='app.log', filemode='w', level=logging.DEBUG)
+import multiprocessing
 
-from flair.models import SequenceTagger
-from flair.data import Sentence
 from ucscenario.src.api.utils.diagram_generator_api import *
 from dfd_to_padfd import generate_pa_dfd_xml
 
-import spacy
 import os
-import csv
-import networkx as nx
+import shutil
+import tempfile
 import string
 import json
-from shutil import copyfile
-from so_that import process_so_that, split_us
+from so_that import process_so_that, StoryAnalysis, analyze_stories, parse_stories, DEFAULT_PARSE_BATCH_SIZE
 from similarity_util import get_similarity
+from robustness import RobustnessDiagram, Element
+from dfd_graph import DfdGraph
+from model_registry import get_ner_model, get_nlp, model_fingerprint
+from ner_inference import tag_stories, DEFAULT_MINI_BATCH_SIZE
+from flask import has_app_context
 
 from nltk.stem import WordNetLemmatizer
 lemmatizer = WordNetLemmatizer()
 
 import collections
 
+# output folders of the robustness diagram generator (ucscenario), shared by every job
+ROBUST_FOLDERS = ["ucscenario/src/api/out/multi/", "ucscenario/src/api/out/single/"]
+
+def move_file(src, dst):
+    # a rename on the same file system, a copy only across file systems
+    try:
+        os.replace(src, dst)
+    except OSError:
+        shutil.move(src, dst)
+
+# modules imported once by the fork server of the DFD workers, instead of the __main__ module (app.py)
+FORKSERVER_PRELOAD = ["ucscenario.src.api.utils.diagram_generator_api", "dfd_to_padfd"]
+
+# StoryDFD of the current worker process, see processDFDPerStory with n_workers > 1
+_worker_dfd = None
+
+def configure_logging(filemode):
+    # only the first call configures the root logger: 'w' in the web process, the workers append to its log
+    logging.basicConfig(filename='app.log', filemode=filemode, level=logging.DEBUG)
+
+def _init_worker(root_folder, personal_data_entities, privacy_only, keep_robust_files, keep_dfd_csv):
+    # the stories arrive analysed, the workers load no model and never use the database
+    global _worker_dfd
+
+    configure_logging('a')
+    _worker_dfd = StoryDFD(root_folder, load_models=False)
+    _worker_dfd.personal_data_entities = personal_data_entities
+    _worker_dfd.privacy_only = privacy_only
+    _worker_dfd.keep_robust_files = keep_robust_files
+    _worker_dfd.keep_dfd_csv = keep_dfd_csv
+
+def _process_story_chunk(chunk):
+    # chunk is a list of (key, story, output name, so that dict), returns a list of (key, story, DfdGraph or None, error or None)
+    results = []
+    for key, story, dfd_output_name_num, so_that in chunk:
+        try:
+            results.append((key, story, _worker_dfd.processStoryDFD(story, dfd_output_name_num, so_that), None))
+        except Exception as e:
+            results.append((key, story, None, str(e)))
+
+    return results
+
+def _release_database():
+    # commit the NER cache rows of the analyses and close every connection before the workers are started
+    if has_app_context():
+        from model import db
+        db.session.commit()
+        db.session.remove()
+        db.engine.dispose()
+
 class StoryDFD():
-    def __init__(self, dfd_folder):
-        self.initModels()
+    def __init__(self, dfd_folder, load_models=True):
+        if load_models:
+            configure_logging('w')
+            self.initModels()
         self.privacy_only = False
+        self.ner_batch_size = DEFAULT_MINI_BATCH_SIZE
+        self.nlp_batch_size = DEFAULT_PARSE_BATCH_SIZE
+        self.nlp_n_process = 1
+        # worker processes of processDFDPerStory, 1 processes the stories in this process
+        self.n_workers = 1
+        # the workers need no model, they are started from a fresh fork server instead of forking the (multithreaded) web process
+        self.mp_start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.analyses = {}
         self.so_that = {}
         self.root_folder = dfd_folder
+        # keep the robustness diagram (_robust.txt and _robust.png) next to every DFD
+        self.keep_robust_files = True
+        # keep the drawio CSV (.csv) of every DFD, the triples are read from the DfdGraph returned by robustToDFD
+        self.keep_dfd_csv = True
 
     def initModels(self):
+        # the models are shared with the rest of the process, see model_registry
         logging.info('Initating NER Model')
-        NER_MODEL_PATH = "static/model/ner-model-roberta-aug-mr-jean-baptiste.pt"
-        self.model = SequenceTagger.load(NER_MODEL_PATH)
+        self.model = get_ner_model()
 
         logging.info('Initating Spacy NLP Model')
-        self.nlp = spacy.load("en_core_web_sm")
+        self.nlp = get_nlp()
 
 
     def setStories(self, stories, stories_id):
@@ -82,7 +147,7 @@ class StoryDFD():
 
         for i, entities in enumerate(self.ner_data):
             for entity in entities:
-                label = entity.get_label("ner").value
+                label = entity.label
 
                 if entity_label != label:
                     continue
@@ -138,15 +203,18 @@ class StoryDFD():
 
         return result
 
-    def generateSoThatDict(self, story):            
-        actors, verb, personal_data = process_so_that(story)
-        if personal_data:
-            first, second, third, idx_cut_first, idx_cut_second = split_us(story)
+    def generateSoThatDict(self, story):
+        # one NER pass and one parse per story, shared by the so that parsing and robustToDFD
+        analysis = self.analyses.get(story)
+        if analysis is None:
+            analysis = StoryAnalysis(story)
 
+        actors, verb, personal_data = process_so_that(story, analysis)
+        if personal_data:
             self.so_that[story] = {
-                "first" : first,
-                "second" : second,
-                "third" : third,
+                "first" : analysis.first_text,
+                "second" : analysis.second_text,
+                "third" : analysis.third_text,
                 "actor" : actors,
                 "verb" : verb,
                 "personal_data" : personal_data,
@@ -160,21 +228,19 @@ class StoryDFD():
 
     def buildNER(self):
         logging.info('Inferring NER')
-        self.ner_data = []
-        for i, story in enumerate(self.stories):
-            sentence = Sentence(story)
-            self.model.predict(sentence)
-            self.ner_data.append(sentence.get_spans('ner'))
-            ## old flair
-            ## self.ner_data.append(sentence.to_dict(tag_type='ner'))
+        self.ner_data = tag_stories(self.stories, self.model, self.ner_batch_size, model_fingerprint("ner"))
 
     def buildNLP(self):
         logging.info('Building NLP data from the Stories')
 
-        self.nlp_data = []
-        for i, story in enumerate(self.stories):
-            doc = self.nlp(story)
-            self.nlp_data.append(doc)
+        self.nlp_data = parse_stories(self.stories, self.nlp_batch_size, self.nlp_n_process)
+
+    def buildAnalyses(self, stories):
+        # NER and parse of the stories in bulk, before the per story DFD generation
+        logging.info('Analysing the Stories')
+
+        analyses = analyze_stories(stories, self.ner_batch_size, self.nlp_batch_size, self.nlp_n_process)
+        self.analyses = {analysis.text: analysis for analysis in analyses}
 
     
     def preprocessWord(self, word):
@@ -183,7 +249,19 @@ class StoryDFD():
 
         return word
 
+    def storyKey(self, i):
+        # id of the story when known, its 1-based position otherwise
+        if self.stories_id:
+            return self.stories_id[i]
+
+        return i+1
+
+    def storyOutputName(self, dfd_folder, i):
+        return dfd_folder + "s_{}".format(self.storyKey(i))
+
     def processDFDPerStory(self, folder_output, unify_dfd=False):
+        # returns the DfdGraph of every story generated now, by story id (see storyKey),
+        # the stories whose DFD already exists are skipped
         self.buildNER()
 
         dfd_folder = self.root_folder + folder_output + "/"
@@ -192,42 +270,36 @@ class StoryDFD():
         if not os.path.exists(dfd_folder):
             os.mkdir(dfd_folder)
 
+        graphs = {}
         error_story = []
         error_cause = []
         if not unify_dfd:
-            for i, story in enumerate(self.stories):
-                dfd_output_name_num = dfd_folder + "s_{}".format(i+1)
+            pending = [(self.storyKey(i), story, self.storyOutputName(dfd_folder, i)) for i, story in enumerate(self.stories) if not os.path.exists(self.storyOutputName(dfd_folder, i) + '.xml')]
 
-                if self.stories_id:
-                    dfd_output_name_num = dfd_folder + "s_{}".format(self.stories_id[i])
+            # NER and parse in this process, in bulk, also when the DFDs are generated by worker processes
+            self.buildAnalyses([story.replace(".","") for _, story, _ in pending])
 
-                if os.path.exists(dfd_output_name_num + '.xml'):
-                    continue
-
-                try:
-
-                    result = DiagramGenerator.generate(story)
-
-                    self.so_that = {}
-                    self.generateSoThatDict(story.replace(".",""))
-
-                    print("**"*10)
-                    print(story)
-                    print(self.so_that)
-                    print("**"*10)
+            if self.n_workers > 1 and len(pending) > 1:
+                results = self.processStoriesInPool(pending)
+            else:
+                results = []
 
-                    if self.so_that:
-                        with open(dfd_output_name_num + "_so.txt", 'w') as ff:
-                            ff.write(str(self.so_that))
+                for key, story, dfd_output_name_num in pending:
+                    try:
+                        results.append((key, story, self.processStoryDFD(story, dfd_output_name_num), None))
+                    except Exception as e:
+                        results.append((key, story, None, str(e)))
 
-                    self.robustToDFD(result["id"], dfd_output_name_num)
-                    
-                except Exception as e:
+            for key, story, graph, error in results:
+                if error is not None:
                     error_story.append(story)
-                    error_cause.append(str(e))
+                    error_cause.append(error)
+                elif graph is not None:
+                    graphs[key] = graph
 
         else:
             self.filtered_stories = self.stories
+            self.buildAnalyses(self.stories)
             self.so_that = {}
             for story in self.stories:
                 self.generateSoThatDict(story)
@@ -244,6 +316,64 @@ class StoryDFD():
                 f.write(error_cause[i])
                 f.write("=="*10)
 
+        return graphs
+
+    def storySoThat(self, story):
+        # so that dict of one story, empty when its so that part has no personal data
+        self.so_that = {}
+        self.generateSoThatDict(story.replace(".",""))
+
+        return self.so_that
+
+    def processStoryDFD(self, story, dfd_output_name_num, so_that=None):
+        # DFD of one story, the so that dict is computed from self.analyses when not given
+        result = DiagramGenerator.generate(story)
+
+        self.so_that = so_that if so_that is not None else self.storySoThat(story)
+
+        print("**"*10)
+        print(story)
+        print(self.so_that)
+        print("**"*10)
+
+        if self.so_that:
+            with open(dfd_output_name_num + "_so.txt", 'w') as ff:
+                ff.write(str(self.so_that))
+
+        return self.robustToDFD(result["id"], dfd_output_name_num)
+
+    def processStoriesInPool(self, pending):
+        # fan the (key, story, output name) tuples out to n_workers processes, returns (key, story, DfdGraph or None, error or None)
+        # of every story, the so that part of the stories is parsed here (see buildAnalyses), the workers only get its result
+        results = []
+        jobs = []
+        for key, story, dfd_output_name_num in pending:
+            try:
+                jobs.append((key, story, dfd_output_name_num, self.storySoThat(story)))
+            except Exception as e:
+                results.append((key, story, None, str(e)))
+
+        if not jobs:
+            return results
+
+        n_chunks = min(len(jobs), self.n_workers * 4)
+        chunks = [jobs[i::n_chunks] for i in range(n_chunks)]
+
+        _release_database()
+
+        context = multiprocessing.get_context(self.mp_start_method)
+        if self.mp_start_method == "forkserver":
+            # the fork server imports the diagram generators once, every worker is forked from it
+            context.set_forkserver_preload(FORKSERVER_PRELOAD)
+
+        initargs = (self.root_folder, self.personal_data_entities, self.privacy_only, self.keep_robust_files, self.keep_dfd_csv)
+
+        with context.Pool(self.n_workers, initializer=_init_worker, initargs=initargs) as pool:
+            for chunk_results in pool.imap_unordered(_process_story_chunk, chunks):
+                results.extend(chunk_results)
+
+        return results
+
     def processDFDFromList(self, story_list, folder_output, filename):
         dfd_folder = self.root_folder + folder_output + "/"
 
@@ -256,7 +386,7 @@ class StoryDFD():
         self.filtered_stories = story_list
 
         self.buildNER()
-        self.buildNLP()
+        self.buildAnalyses(self.filtered_stories)
 
         _, self.personal_data_entities = self.getUniqueEntitiesByLabel("PII")
 
@@ -266,7 +396,7 @@ class StoryDFD():
         for story in self.filtered_stories:
             self.generateSoThatDict(story)
 
-        self.robustToDFD(robustness_result["id"], dfd_output_name)
+        return self.robustToDFD(robustness_result["id"], dfd_output_name)
 
     def processDFDPerEntity(self, process_all=False, us_name=None, based_on="data_subject", force_single=False):
         self.buildNER()
@@ -386,152 +516,150 @@ class StoryDFD():
         os.system("dot -Tpng \"{}.dot\" -o \"{}_dfd.png\"".format(dfd_output_name, dfd_output_name))
 
 
+    def keepsRobustnessOutput(self, dfd_output_name=None):
+        return self.keep_robust_files and dfd_output_name is not None
+
+    def claimRobustnessOutput(self, ROBUST_FILE, dfd_output_name=None):
+        # .txt of a robustness diagram of the generator folders, the kept .txt and .png are moved
+        # next to the DFD once, the others are parsed where they are (and deleted by robustToDFD)
+        for folder in ROBUST_FOLDERS:
+            if os.path.isfile(folder + ROBUST_FILE + ".txt"):
+                break
+
+        source = folder + ROBUST_FILE
+        if not self.keepsRobustnessOutput(dfd_output_name):
+            return source + ".txt"
+
+        target = dfd_output_name + "_robust"
+        move_file(source + ".txt", target + ".txt")
+        if os.path.isfile(source + ".png"):
+            move_file(source + ".png", target + ".png")
+
+        return target + ".txt"
+
     def robustToDFD(self, ROBUST_FILE, dfd_output_name=None):
-        # DRAW IO STYLE
-
-        DFD_CSV_HEADER = ["id","value","style","source","target","type"]
-        DFD_PROP = {
-            'external_entity' : {
-                'style' : 'rounded=0',
-                'type' : 'external_entity'
-            }, 
-            'process' : {
-                'style' : 'ellipse',
-                'type' : 'process'
-            }, 
-            'dataflow' : {
-                'style' : 'endArrow=classic',
-                'type' : 'endArrow=classic'
-            }, 
-            'datastore' : {
-                'style' : 'shape=partialRectangle',
-                'type' : 'data_base'
-            }, 
-        }
-
-        FILE_ROBUST = "ucscenario/src/api/out/multi/" + ROBUST_FILE + ".txt"
-        if not os.path.isfile(FILE_ROBUST):
-            FILE_ROBUST = "ucscenario/src/api/out/single/" + ROBUST_FILE + ".txt"
-
-        copyfile(FILE_ROBUST, dfd_output_name + "_robust.txt")
-        copyfile(FILE_ROBUST.replace(".txt", ".png"), dfd_output_name + "_robust.png")
+        # ROBUST_FILE is the id returned by DiagramGenerator, or a RobustnessDiagram already in memory
+        # returns the DfdGraph of the DFD
+        if isinstance(ROBUST_FILE, RobustnessDiagram):
+            return self.robustDiagramToDFD(ROBUST_FILE, dfd_output_name)
+
+        FILE_ROBUST = self.claimRobustnessOutput(ROBUST_FILE, dfd_output_name)
 
+        try:
+            # the file is parsed once, the DFD is built from the parsed diagram
+            graph = self.robustDiagramToDFD(RobustnessDiagram.from_file(FILE_ROBUST), dfd_output_name)
+        finally:
+            if not self.keepsRobustnessOutput(dfd_output_name):
+                for robust_file in (FILE_ROBUST, FILE_ROBUST.replace(".txt", ".png")):
+                    if os.path.isfile(robust_file):
+                        os.remove(robust_file)
+
+        return graph
+
+    def robustDiagramToDFD(self, diagram, dfd_output_name=None):
         ext_entity = {}
         process = {}
         boundary = {}
         entity = {}
         id_dfd = 200
         id_process = 1
-        dfd_rows = []
+        graph = DfdGraph()
         dot_rows = ["node[shape=record]"]
-        G = nx.Graph()
         
-        # MAKE A MAPPING FROM ROBUSNESS DIAGRAM FILE
-        with open(FILE_ROBUST, 'r') as ff:
-            
-            for f in ff:
-                uml_part = f.split()
+        # MAKE A MAPPING FROM ROBUSNESS DIAGRAM
+        for statement in diagram.statements:
+
+            if isinstance(statement, Element):
+                alias, label = statement.alias, statement.label
 
                 # external entity is actor, connected to process
-                if len(uml_part) >= 4:
-                    if uml_part[0] == 'actor' and 'as' in uml_part:
-                        alias_index = uml_part.index('as') + 1
-                        ext_entity[uml_part[alias_index]] = {}
+                if statement.kind == 'actor':
+                    ext_entity[alias] = {}
 
-                        ext_entity_label =  ' '.join(uml_part[1:alias_index-1]).replace('"','').replace('\\n',' ')
+                    ext_entity[alias]['label'] = label
+                    ext_entity[alias]['process'] = []
+                    ext_entity[alias]['id_dfd'] = id_dfd
 
-                        ext_entity[uml_part[alias_index]]['label'] = ext_entity_label
-                        ext_entity[uml_part[alias_index]]['process'] = []
-                        ext_entity[uml_part[alias_index]]['id_dfd'] = id_dfd
+                    graph.add_node(id_dfd, 'external_entity', label)
 
-                        row = [id_dfd, ext_entity_label, DFD_PROP['external_entity']['style'], "null", "null", DFD_PROP['external_entity']['type']]
+                    dot_rows.append("{} [label=\"{}\" shape=box];".format(id_dfd, label))
+                    id_dfd += 1
 
-                        dfd_rows.append({"id":row[0], "data":row})
-                        dot_rows.append("{} [label=\"{}\" shape=box];".format(row[0], ext_entity_label))
-                        id_dfd += 1
 
+                # boundary act as a bridge from actor to process
+                if statement.kind == 'boundary':
+                    boundary[alias] = {}
 
-                    # boundary act as a bridge from actor to process
-                    if uml_part[0] == 'boundary' and 'as' in uml_part:
-                        alias_index = uml_part.index('as') + 1
-                        boundary[uml_part[alias_index]] = {}
+                    boundary[alias]['label'] = label
+                    boundary[alias]['actor'] = []
 
-                        boundary[uml_part[alias_index]]['label'] = ' '.join(uml_part[1:alias_index-1]).replace('"','').replace('\\n',' ')
-                        boundary[uml_part[alias_index]]['actor'] = []
+                # control is process
+                if statement.kind == 'control':
+                    process[alias] = {}
 
-                    # control is process
-                    if uml_part[0] == 'control' and 'as' in uml_part:
-                        alias_index = uml_part.index('as') + 1
-                        process[uml_part[alias_index]] = {}
+                    process[alias]['label'] = label
+                    process[alias]['process'] = []
+                    process[alias]['entity'] = []
+                    process[alias]['id_dfd'] = id_dfd
+                    
+                    graph.add_node(id_dfd, 'process', process[alias]['label'])
 
-                        process[uml_part[alias_index]]['label'] = ' '.join(uml_part[1:alias_index-1]).replace('"','').replace('\\n',' ')
-                        process[uml_part[alias_index]]['process'] = []
-                        process[uml_part[alias_index]]['entity'] = []
-                        process[uml_part[alias_index]]['id_dfd'] = id_dfd
-                        
-                        row = [id_dfd, process[uml_part[alias_index]]['label'], DFD_PROP['process']['style'], "null", "null", DFD_PROP['process']['type']]
+                    dot_rows.append("{} [label=\"{{<f0> {}.0|<f1> {} }}\" shape=Mrecord];".format(id_dfd, id_process, process[alias]['label']))
+                    id_dfd += 1
+                    id_process += 1
 
-                        dfd_rows.append({"id":row[0], "data":row})
-                        dot_rows.append("{} [label=\"{{<f0> {}.0|<f1> {} }}\" shape=Mrecord];".format(row[0], id_process, process[uml_part[alias_index]]['label']))
-                        id_dfd += 1
-                        id_process += 1
 
+                # entity can become personal data
+                if statement.kind == 'entity':
+                    entity_label_dfd = label
 
-                    # entity can become personal data
-                    if uml_part[0] == 'entity' and 'as' in uml_part:
-                        alias_index = uml_part.index('as') + 1
-                        entity_label_dfd = ' '.join(uml_part[1:alias_index-1]).replace('"','').replace('\n',' ')
+                    if self.privacy_only:
+                        if entity_label_dfd.lower().strip() not in (lemmatizer.lemmatize(pdata).lower().strip() for pdata in self.personal_data_entities):
+                            continue
 
-                        if self.privacy_only:
-                            if entity_label_dfd.lower().strip() not in (lemmatizer.lemmatize(pdata).lower().strip() for pdata in self.personal_data_entities):
-                                continue
+                    entity[alias] = {}
 
-                        entity[uml_part[alias_index]] = {}
+                    entity[alias]['label'] = entity_label_dfd
+                    entity[alias]['id_dfd'] = id_dfd
+                    entity[alias]['entity'] = []
+                    
+                    graph.add_node(id_dfd, 'datastore', entity[alias]['label'])
 
-                        entity[uml_part[alias_index]]['label'] = entity_label_dfd
-                        entity[uml_part[alias_index]]['id_dfd'] = id_dfd
-                        entity[uml_part[alias_index]]['entity'] = []
-                        
-                        row = [id_dfd, entity[uml_part[alias_index]]['label'], DFD_PROP['datastore']['style'], "null", "null", DFD_PROP['datastore']['type']]
+                    # make red color for PII
+                    color = ""
+                    for pdata in self.personal_data_entities:
+                        if entity_label_dfd.lower().strip() in pdata.lower() or pdata.lower() in entity_label_dfd.lower().strip():
+                            color = "color=red"
+                            break
 
-                        dfd_rows.append({"id":row[0], "data":row})
+                    dot_rows.append("{} [label=\"<f0>  |<f1> {} \" {}];".format(id_dfd, entity[alias]['label'], color))
+                    
+                    id_dfd += 1
 
-                        # make red color for PII
-                        color = ""
-                        for pdata in self.personal_data_entities:
-                            if entity_label_dfd.lower().strip() in pdata.lower() or pdata.lower() in entity_label_dfd.lower().strip():
-                                color = "color=red"
-                                break
 
-                        dot_rows.append("{} [label=\"<f0>  |<f1> {} \" {}];".format(row[0], entity[uml_part[alias_index]]['label'], color))
-                        
-                        id_dfd += 1
+            # the dependency between element
+            elif statement.target in ext_entity or statement.target in process or statement.target in boundary or statement.target in entity:
+                source, target = statement.source, statement.target
 
+                # the connection between actor and boundary must appear first
+                if source in ext_entity:
+                    boundary[target]['actor'].append(source)
 
-                # the dependency between element
-                if len(uml_part) == 3 and (uml_part[-1] in ext_entity or uml_part[-1] in process or uml_part[-1] in boundary or uml_part[-1] in entity):
+                # map actor to process via boundary
+                if source in boundary:
+                    for actor in boundary[source]['actor']:
+                        ext_entity[actor]['process'].append(target)
 
-                    G.add_edge(uml_part[0], uml_part[-1])
-                
-                    # the connection between actor and boundary must appear first
-                    if uml_part[0] in ext_entity:
-                        boundary[uml_part[-1]]['actor'].append(uml_part[0])
-
-                    # map actor to process via boundary
-                    if uml_part[0] in boundary:
-                        for actor in boundary[uml_part[0]]['actor']:
-                            ext_entity[actor]['process'].append(uml_part[-1])
-
-                    # map process to another process
-                    if uml_part[0] in process:
-                        process[uml_part[0]]['process'].append(uml_part[-1])
-
-                    # map entity to process
-                    if uml_part[0] in entity:
-                        if uml_part[-1] in process:
-                            process[uml_part[-1]]['entity'].append(uml_part[0])
-                        else:
-                            entity[uml_part[-1]]['entity'].append(uml_part[0])
+                # map process to another process
+                if source in process:
+                    process[source]['process'].append(target)
+
+                # map entity to process
+                if source in entity:
+                    if target in process:
+                        process[target]['entity'].append(source)
+                    else:
+                        entity[target]['entity'].append(source)
 
         # END OF MAPPING
 
@@ -541,9 +669,8 @@ class StoryDFD():
 
             for story, so_data in self.so_that.items():
                 # processing is always new, start with processing, because it's the center
-                row = [id_process, so_data["verb"], DFD_PROP['process']['style'], "null", "null", DFD_PROP['process']['type']]
-                dfd_rows.append({"id":row[0], "data":row})
-                dot_rows.append("{} [label=\"{{<f0> {}.0|<f1> {} }}\" shape=Mrecord];".format(row[0], id_process, so_data["verb"]))
+                graph.add_node(id_process, 'process', so_data["verb"])
+                dot_rows.append("{} [label=\"{{<f0> {}.0|<f1> {} }}\" shape=Mrecord];".format(id_process, id_process, so_data["verb"]))
 
                 PROCESS_CONNECTED = False
 
@@ -551,29 +678,27 @@ class StoryDFD():
                     for actor_so in so_data['actor']:
                         if get_similarity(actor_so, data_actor['label']) < 0.8:
                             # if we found a new actor in so that, we add it to DFD
-                            row = [id_dfd_so, actor_so.capitalize(), DFD_PROP['external_entity']['style'], "null", "null", DFD_PROP['external_entity']['type']]
+                            graph.add_node(id_dfd_so, 'external_entity', actor_so.capitalize())
 
-                            dfd_rows.append({"id":row[0], "data":row})
-                            dot_rows.append("{} [label=\"{}\" shape=box];".format(row[0], actor_so.capitalize()))
+                            dot_rows.append("{} [label=\"{}\" shape=box];".format(id_dfd_so, actor_so.capitalize()))
                             
                             id_dfd_so += 1
 
                             # directly make the connection
-                            row = [id_dfd_so, "", DFD_PROP['dataflow']['style'], id_dfd_so - 1, id_process, DFD_PROP['dataflow']['type']]
-                            dfd_rows.append({"id":row[0], "data":row})
+                            graph.add_flow(id_dfd_so, id_dfd_so - 1, id_process, "")
                             dot_rows.append("{} -> {}".format(id_dfd_so - 1, id_process))
 
                             id_dfd_so += 1
                         else:
                             # IF IT IS OLD ACTOR; THE ARROW SHOULD COME FROM THE PROCESSING IN THE SECOND PART OF USER STORY
                             for proc in data_actor['process']:
-                                if (process[proc]['label'].strip().lower() in so_data["second"].strip().lower() or get_similarity(process[proc]['label'], so_data["second"]) > 0.7) and not PROCESS_CONNECTED:
+                                second = so_data["second"]
+                                if (process[proc]['label'].strip().lower() in second.strip().lower() or get_similarity(process[proc]['label'], second) > 0.7) and not PROCESS_CONNECTED:
                                     # make the connection from process in the second part of user story
                                     PROCESS_CONNECTED = False
                                     # update : keep it false so triple will be detected
                                     
-                                    row = [id_dfd_so, "", DFD_PROP['dataflow']['style'], process[proc]['id_dfd'], id_process, DFD_PROP['dataflow']['type']]
-                                    dfd_rows.append({"id":row[0], "data":row})
+                                    graph.add_flow(id_dfd_so, process[proc]['id_dfd'], id_process, "")
                                     dot_rows.append("{} -> {}".format(process[proc]['id_dfd'], id_process))
 
                                     id_dfd_so += 1
@@ -581,8 +706,7 @@ class StoryDFD():
 
                             # If No Data Flow connected to our process, then connect it to the actor
                             if not PROCESS_CONNECTED:
-                                row = [id_dfd_so, "", DFD_PROP['dataflow']['style'], data_actor["id_dfd"], id_process, DFD_PROP['dataflow']['type']]
-                                dfd_rows.append({"id":row[0], "data":row})
+                                graph.add_flow(id_dfd_so, data_actor["id_dfd"], id_process, "")
                                 dot_rows.append("{} -> {}".format(data_actor["id_dfd"], id_process))
 
                                 id_dfd_so += 1
@@ -595,8 +719,7 @@ class StoryDFD():
                             NEW_ENTITY = False
 
                             # directly make the connection
-                            row = [id_dfd_so, personal_data_so, DFD_PROP['dataflow']['style'], id_process, data_entity["id_dfd"], DFD_PROP['dataflow']['type']]
-                            dfd_rows.append({"id":row[0], "data":row})
+                            graph.add_flow(id_dfd_so, id_process, data_entity["id_dfd"], personal_data_so)
                             dot_rows.append("{} -> {}  [label=\"{}\"]".format(id_process, data_entity["id_dfd"], personal_data_so))
 
                             id_dfd_so += 1
@@ -604,16 +727,14 @@ class StoryDFD():
                         
                     # if we found a new personal data in so that, we add it to DFD
                     if NEW_ENTITY:
-                        row = [id_dfd_so, personal_data_so, DFD_PROP['datastore']['style'], "null", "null", DFD_PROP['datastore']['type']]
+                        graph.add_node(id_dfd_so, 'datastore', personal_data_so)
 
-                        dfd_rows.append({"id":row[0], "data":row})
-                        dot_rows.append("{} [label=\"<f0>  |<f1> {} \" {}];".format(row[0], personal_data_so, "color=red"))
+                        dot_rows.append("{} [label=\"<f0>  |<f1> {} \" {}];".format(id_dfd_so, personal_data_so, "color=red"))
                         
                         id_dfd_so += 1
 
                         # directly make the connection
-                        row = [id_dfd_so, personal_data_so, DFD_PROP['dataflow']['style'], id_process, id_dfd_so - 1, DFD_PROP['dataflow']['type']]
-                        dfd_rows.append({"id":row[0], "data":row})
+                        graph.add_flow(id_dfd_so, id_process, id_dfd_so - 1, personal_data_so)
                         dot_rows.append("{} -> {} [label=\"{}\"]".format(id_process, id_dfd_so - 1, personal_data_so))
 
                         id_dfd_so += 1
@@ -630,8 +751,7 @@ class StoryDFD():
                 # arrow connection is different element
                 # i'm still not sure about the label between actor and process
                 id_dfd += 1
-                row = [id_dfd, "", DFD_PROP['dataflow']['style'], v['id_dfd'], process[proc]['id_dfd'], DFD_PROP['dataflow']['type']]
-                dfd_rows.append({"id":row[0], "data":row})
+                graph.add_flow(id_dfd, v['id_dfd'], process[proc]['id_dfd'], "")
                 dot_rows.append("{} -> {}".format(v['id_dfd'], process[proc]['id_dfd']))
 
         mapped_entity = []
@@ -640,15 +760,13 @@ class StoryDFD():
             # i'm still not sure about the label between process
             for proc in v['process']:
                 id_dfd += 1
-                row = [id_dfd, "", DFD_PROP['dataflow']['style'], v['id_dfd'], process[proc]['id_dfd'], DFD_PROP['dataflow']['type']]
-                dfd_rows.append({"id":row[0], "data":row})
+                graph.add_flow(id_dfd, v['id_dfd'], process[proc]['id_dfd'], "")
                 dot_rows.append("{} -> {}".format(v['id_dfd'], process[proc]['id_dfd']))
 
             # arrow connection between process and data store
             for ent in v['entity']:
                 id_dfd += 1
-                row = [id_dfd, entity[ent]['label'], DFD_PROP['dataflow']['style'], v['id_dfd'], entity[ent]['id_dfd'], DFD_PROP['dataflow']['type']]
-                dfd_rows.append({"id":row[0], "data":row})
+                graph.add_flow(id_dfd, v['id_dfd'], entity[ent]['id_dfd'], entity[ent]['label'])
                 dot_rows.append("{} -> {} [label=\"{}\"]".format(v['id_dfd'], entity[ent]['id_dfd'], entity[ent]['label']))
 
                 mapped_entity.append(entity[ent]['label'])
@@ -664,28 +782,32 @@ class StoryDFD():
                 id_dfd += 1
 
                 if v["label"].strip().lower() in vp["label"].strip().lower():
-                    row = [id_dfd, v['label'], DFD_PROP['dataflow']['style'], vp['id_dfd'], v['id_dfd'], DFD_PROP['dataflow']['type']]
-                    dfd_rows.append({"id":row[0], "data":row})
+                    graph.add_flow(id_dfd, vp['id_dfd'], v['id_dfd'], v['label'])
                     dot_rows.append("{} -> {} [label=\"{}\"]".format(vp['id_dfd'], v['id_dfd'], v['label']))
 
                     break
 
 
 
-        dfd_rows.sort(key=lambda x: x.get('id'))
-        sorted_dfd_rows = [v["data"] for v in dfd_rows]
-        sorted_dfd_rows.insert(0, DFD_CSV_HEADER)
-
         self.generateDfdGraphiz(dot_rows, dfd_output_name)
 
-        with open(dfd_output_name + '.csv', 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerows(sorted_dfd_rows)
-        
+        # the drawio CSV is the input of the PA-DFD converter, it stays next to the DFD only with keep_dfd_csv
+        if self.keep_dfd_csv:
+            csv_file = dfd_output_name + '.csv'
+        else:
+            fd, csv_file = tempfile.mkstemp(suffix='.csv')
+            os.close(fd)
 
-        pa_dfd_xml=generate_pa_dfd_xml(dfd_output_name + '.csv',dfd_output_name + '.xml')
+        try:
+            graph.write_csv(csv_file)
+            pa_dfd_xml=generate_pa_dfd_xml(csv_file, dfd_output_name + '.xml')
+        finally:
+            if not self.keep_dfd_csv:
+                os.remove(csv_file)
 
         # END GENERATE DFD
+
+        return graph
     
 
 
@@ -0,0 +1,99 @@
+import csv
+from collections import namedtuple
+'''
+Typed data flow diagram built by StoryDFD.robustDiagramToDFD: external entities, processes and data stores
+connected by data flows. The (external entity, process, data store) triples saved as Dfd_triple and
+Dfd_triple_group rows are read from it with DfdGraph.triples:
+
+    graph = dd.processDFDFromList(stories, project_name + "Group", filename)
+    for external_entity, process, data_store in graph.triples():
+        ...
+
+The drawio-style CSV (id, value, style, source, target, type) is only an export, read by the PA-DFD
+converter (dfd_to_padfd) and by DfdGraph.from_csv for the DFDs generated before the graph was kept.
+'''
+
+NODE_KINDS = ("external_entity", "process", "datastore")
+
+CSV_HEADER = ["id", "value", "style", "source", "target", "type"]
+# drawio style and type of every kind of node, and of the data flows
+CSV_PROP = {
+    'external_entity' : ('rounded=0', 'external_entity'),
+    'process' : ('ellipse', 'process'),
+    'datastore' : ('shape=partialRectangle', 'data_base'),
+    'dataflow' : ('endArrow=classic', 'endArrow=classic'),
+}
+CSV_KINDS = {csv_type: kind for kind, (_, csv_type) in CSV_PROP.items()}
+
+# id is the drawio id of the element, source and target are node ids
+Node = namedtuple('Node', ['id', 'kind', 'label'])
+Flow = namedtuple('Flow', ['id', 'source', 'target', 'label'])
+
+
+class DfdGraph(object):
+    def __init__(self):
+        self.nodes = {}
+        # data flows, in the order they were added
+        self.flows = []
+
+    def __repr__(self):
+        return "DfdGraph({} nodes, {} flows)".format(len(self.nodes), len(self.flows))
+
+    def add_node(self, id, kind, label):
+        if kind not in NODE_KINDS:
+            raise ValueError("Unknown node kind {}".format(kind))
+
+        self.nodes[id] = Node(id, kind, label)
+
+    def add_flow(self, id, source, target, label=""):
+        self.flows.append(Flow(id, source, target, label))
+
+    def kind(self, id):
+        node = self.nodes.get(id)
+        return node.kind if node else None
+
+    def triples(self):
+        # (external entity, process, data store) labels of every path external entity -> process -> data store,
+        # one pass over the flows to index the data stores of every process, one to walk from the external entities
+        data_stores = {}
+        for flow in self.flows:
+            if self.kind(flow.source) == "process" and self.kind(flow.target) == "datastore":
+                data_stores.setdefault(flow.source, []).append(flow.target)
+
+        triples = []
+        for flow in self.flows:
+            if self.kind(flow.source) == "external_entity" and flow.target in data_stores:
+                for data_store in data_stores[flow.target]:
+                    triples.append((self.nodes[flow.source].label, self.nodes[flow.target].label, self.nodes[data_store].label))
+
+        return triples
+
+    def rows(self):
+        # drawio rows sorted by id, without the header
+        rows = [[node.id, node.label, CSV_PROP[node.kind][0], "null", "null", CSV_PROP[node.kind][1]] for node in self.nodes.values()]
+        rows.extend([flow.id, flow.label, CSV_PROP['dataflow'][0], flow.source, flow.target, CSV_PROP['dataflow'][1]] for flow in self.flows)
+        rows.sort(key=lambda row: row[0])
+
+        return rows
+
+    def write_csv(self, filename):
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(CSV_HEADER)
+            writer.writerows(self.rows())
+
+    @classmethod
+    def from_csv(cls, filename):
+        graph = cls()
+
+        with open(filename, 'r') as csvfile:
+            rows = csv.reader(csvfile, delimiter=',')
+            next(rows)
+
+            for row in rows:
+                if row[-1] == CSV_PROP['dataflow'][1]:
+                    graph.add_flow(row[0], row[3], row[4], row[1])
+                elif row[-1] in CSV_KINDS:
+                    graph.add_node(row[0], CSV_KINDS[row[-1]], row[1])
+
+        return graph
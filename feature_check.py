@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from nltk.tokenize import word_tokenize
+import feature_engineering
+from feature_engineering import PrivacyPatternFeatures
+'''
+Check the lexical LTR features (1 - 20) of PrivacyPatternFeatures.features_for against the per-pattern
+implementation they replaced, kept below as reference_features (one query, one pattern at a time):
+
+    python feature_check.py
+    python feature_check.py --patterns LTR_resources/patterns.json --queries requirements.txt
+
+Without arguments the corpus and the queries are synthetic (seeded): words in several cases, words that
+are substrings of other words, punctuation, stop words and query words missing from the corpus. The
+features are built with the lexical feature set in a temporary directory, so LTR_resources/pattern_index.pkl
+is not touched. It reports, for every feature, the largest difference and whether the values are
+bit-identical, and exits with 1 when a feature differs by more than --rtol.
+'''
+
+WORDS = ["data", "metadata", "Data", "user", "users", "User", "consent", "location", "anonymity", "anonymous",
+         "pseudonym", "pseudonymous", "identity", "access", "control", "log", "login", "share", "shared",
+         "encrypt", "encryption", "notice", "privacy", "policy", "the", "a", "of", "to", "is", "with",
+         "e-mail", "opt-in", "third-party", ",", ".", "(", ")"]
+# query words that are in no pattern
+UNKNOWN_WORDS = ["blockchain", "biometric", "geofence"]
+
+
+def synthetic_patterns(rng, n_patterns=40):
+    # patterns.json entries, heading contents are joined to the text of the pattern like the real ones
+    patterns = []
+    for i in range(n_patterns):
+        patterns.append({
+            "filename" : "pattern-{}.md".format(i),
+            "excerpt" : " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 15))),
+            "heading" : [{"content" : " ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 60)))} for _ in range(rng.randint(0, 4))],
+        })
+
+    return patterns
+
+
+def synthetic_queries(rng, n_queries=50):
+    # every query has a word of the corpus, the idf feature is undefined otherwise
+    queries = []
+    for _ in range(n_queries):
+        words = [rng.choice(WORDS + UNKNOWN_WORDS) for _ in range(rng.randint(1, 12))]
+        words.append(rng.choice(["data", "user", "consent", "privacy"]))
+        rng.shuffle(words)
+        queries.append("The system shall " + " ".join(words))
+
+    return queries
+
+
+def reference_bm25(pp, q):
+    # BM25 of one query against every pattern, the CountVectorizer is applied to the patterns for each query
+    b, k1 = pp.b, pp.k1
+    count_vectorizer = super(TfidfVectorizer, pp.tf_idf_vectorizer)
+
+    X = count_vectorizer.transform(pp.patterns)
+    avdl = X.sum(1).mean()
+    len_X = X.sum(1).A1
+    q, = count_vectorizer.transform([q])
+
+    X = X.tocsc()[:, q.indices]
+    denom = X + (k1 * (1 - b + b * len_X / avdl))[:, None]
+    idf = pp.tf_idf_vectorizer._tfidf.idf_[None, q.indices] - 1.
+    numer = X.multiply(np.broadcast_to(idf, X.shape)) * (k1 + 1)
+
+    return (numer / denom).sum(1).A1
+
+
+def reference_idf(pp, q_words):
+    # 1 divided by the number of query words found in the patterns
+    word_in_patterns = set()
+    for pattern in pp.patterns:
+        for word in q_words:
+            if word.lower() in pattern.lower():
+                word_in_patterns.add(word.lower())
+
+    return 1/len(list(word_in_patterns))
+
+
+def reference_tf_idf(pp, q):
+    tfidf_matrix = pp.tf_idf_vectorizer.transform([q]).todense()
+    feature_index = tfidf_matrix[0,:].nonzero()[1]
+    tfidf_scores = zip([pp.tf_idf_feature_names[i] for i in feature_index], [tfidf_matrix[0, x] for x in feature_index])
+
+    word_scores = [score for score in dict(tfidf_scores).values()]
+
+    return [sum(word_scores), min(word_scores), max(word_scores), np.average(word_scores), np.var(word_scores)]
+
+
+def reference_features(pp, q):
+    # (n_patterns x 20) lexical features of one query, one pattern at a time
+    q_filtered = pp.remove_stopwords(q)
+    q_words = word_tokenize(q_filtered)
+
+    len_q = len(q_filtered)
+    idf_q = reference_idf(pp, q_words)
+    tf_idf_q = reference_tf_idf(pp, q)
+    bm25 = reference_bm25(pp, q)
+
+    features_all = []
+    for i, pattern in enumerate(pp.patterns):
+        features = []
+        features.extend(pp.number_of_covered_words(q_words, pattern)) # 1, 2
+        features.append(len_q) # 3
+        features.append(idf_q) # 4
+        features.extend(pp.tf_features(q_words, pattern)) # 5 - 14
+        features.extend(tf_idf_q) # 15 - 19
+        features.append(bm25[i]) # 20
+
+        features_all.append(features)
+
+    return np.array(features_all, dtype=np.float64)
+
+
+def build_features(patterns):
+    # lexical PrivacyPatternFeatures of the patterns, built in a temporary directory
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="feature_check_")
+    try:
+        os.chdir(directory)
+        os.mkdir(os.path.dirname(feature_engineering.PATTERN_FILE))
+        with open(feature_engineering.PATTERN_FILE, 'w') as f:
+            json.dump(patterns, f)
+
+        return PrivacyPatternFeatures(feature_set="lexical")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the lexical LTR features with the per-pattern reference implementation")
+    parser.add_argument("--patterns", help="patterns.json, a synthetic corpus by default")
+    parser.add_argument("--queries", help="one query per line, synthetic queries by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rtol", type=float, default=1e-12)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.patterns:
+        with open(args.patterns, 'r') as f:
+            patterns = json.load(f)
+    else:
+        patterns = synthetic_patterns(rng)
+
+    if args.queries:
+        with open(args.queries, 'r', encoding='utf-8') as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = synthetic_queries(rng)
+
+    pp = build_features(patterns)
+    features = pp.features_for(queries)[:, :, :20]
+    reference = np.stack([reference_features(pp, q) for q in queries])
+
+    print("{} patterns, {} queries".format(len(pp.patterns), len(queries)))
+    print("{:>8} {:>14} {:>14}".format("feature", "max diff", "identical"))
+
+    failed = False
+    for j in range(features.shape[-1]):
+        difference = np.abs(features[..., j] - reference[..., j])
+        identical = np.array_equal(features[..., j], reference[..., j])
+        failed |= not np.allclose(features[..., j], reference[..., j], rtol=args.rtol, atol=0)
+
+        print("{:>8} {:>14.3g} {:>14}".format(j + 1, difference.max(), "yes" if identical else "no"))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
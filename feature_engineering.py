@@ -1,91 +1,251 @@
-import json, pickle, os
+import json, pickle, os, hashlib
+from bisect import bisect_right
+from collections import Counter
 import numpy as np
+import nltk
 from sklearn.feature_extraction.text import TfidfVectorizer
 from scipy import sparse
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
+from pattern_catalog import PATTERN_FILE, get_lookup_patterns
 '''
-Construct features for learning-to-rank
-The main function is the construct_features(q) which receives input of a query (which in our case a requirement)
-then it is computed for each pattern in privacypatterns.org
+Construct features for learning-to-rank: 26 features of a query (a requirement) against every pattern of
+privacypatterns.org, 20 lexical features and 6 cosine similarities of two sentence encoders.
+
+    pp = PrivacyPatternFeatures(feature_set="full")
+    features = pp.features_for(texts)                     # (len(texts) x n_patterns x 26)
+    features = pp.construct_feature_blocks(texts, cache)  # same, reads and stores the blocks in LtrFeatureBlock
+
+lexical_features(queries) returns the BM25 and TF-IDF features of many queries at once. FEATURE_SETS lists the
+encoders of each feature set (full, minilm, lexical), the features of the encoders that are not loaded are 0.
+Nothing about the queries is kept on the instance, so one PrivacyPatternFeatures serves concurrent requests.
 '''
 
+N_FEATURES = 26
+# bump when a feature is added, removed or computed differently, the stored feature blocks are then recomputed
+FEATURE_SCHEMA_VERSION = 2
+
+PATTERN_INDEX_FILE = "LTR_resources/pattern_index.pkl"
+PATTERN_INDEX_VERSION = 2
+# the cache of the patterns covering a query word is emptied past this size
+COVERING_CACHE_SIZE = 100000
+
+ENCODERS = {
+    "minilm" : 'all-MiniLM-L6-v2',
+    "overflow" : 'flax-sentence-embeddings/stackoverflow_mpnet-base',
+}
+# encoders used by each feature set, the semantic features of the other encoder are 0
+# lexical features 1 - 20 are always computed, see ltr_benchmark.py for the ranking quality of each set
+FEATURE_SETS = {
+    "full" : ("minilm", "overflow"),
+    "minilm" : ("minilm",),
+    "lexical" : (),
+}
+# one store per encoder, the .npy holds the patterns, then the titles, then the excerpts
+EMBEDDING_STORE_FILE = "LTR_resources/emb_{}.npy"
+EMBEDDING_HEADER_FILE = "LTR_resources/emb_{}.json"
+EMBEDDING_STORE_VERSION = 2
+
+def normalize_rows(embeddings):
+    # float32 rows of unit length, as util.cos_sim normalizes them
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    return embeddings / np.maximum(norms, 1e-12)
+
 class PrivacyPatternFeatures(object):
-    def __init__(self):
+    def __init__(self, quantize=False, feature_set="full"):
+        if feature_set not in FEATURE_SETS:
+            raise ValueError("Unknown feature set {}, use one of {}".format(feature_set, ", ".join(FEATURE_SETS)))
+
+        self.quantize = quantize
+        self.feature_set = feature_set
         self.patterns, self.pattern_titles, self.pattern_excerpts = self.get_corpus_pattern()
+        self.initiate_pattern_index()
+        self.initiate_term_counts()
         self.initiate_tf_idf()
         self.initiate_bm25(0.75, 1.6)
         
         print("Loading LTR Embeddings...")
-        self.model_sentence_transformer = SentenceTransformer('all-MiniLM-L6-v2')
-        self.model_sentence_transformer_overflow = SentenceTransformer('flax-sentence-embeddings/stackoverflow_mpnet-base')
-        
-        self.emb_pattern_file = 'LTR_resources/emb_pattern.pkl'
-        if os.path.isfile(self.emb_pattern_file):
-            self.load_pattern_embeddings()
+        # encoder key -> SentenceTransformer, only the encoders of the feature set
+        self.encoders = {key : SentenceTransformer(ENCODERS[key]) for key in FEATURE_SETS[feature_set]}
+
+        # the stored pattern embeddings are computed with the fp32 encoders
+        # encoder key -> normalized (3 * n_patterns x dim) embeddings of the patterns, titles and excerpts
+        self.pattern_embeddings = {key : self.load_embedding_store(key, encoder) for key, encoder in self.encoders.items()}
+
+        if quantize:
+            # int8 encoders for CPU inference, the stored pattern embeddings stay fp32
+            from model_registry import quantize_dynamic_int8
+            self.encoders = {key : quantize_dynamic_int8(encoder) for key, encoder in self.encoders.items()}
+
+    def corpus_texts(self):
+        # every text with a stored embedding, in the order of the rows of the store
+        return self.patterns + self.pattern_titles + self.pattern_excerpts
+
+    def embedding_store_header(self, key):
+        corpus = json.dumps(self.corpus_texts()).encode('utf-8')
+
+        return {
+            "version" : EMBEDDING_STORE_VERSION,
+            "model" : ENCODERS[key],
+            "corpus" : hashlib.sha256(corpus).hexdigest(),
+            "rows" : len(self.patterns),
+        }
+
+    def build_embedding_store(self, key, encoder, header):
+        embeddings = normalize_rows(encoder.encode(self.corpus_texts(), convert_to_numpy=True))
+
+        # write to temporary files first, a reader never sees a partial store
+        store_file, header_file = EMBEDDING_STORE_FILE.format(key), EMBEDDING_HEADER_FILE.format(key)
+        with open(store_file + ".tmp{}".format(os.getpid()), 'wb') as f:
+            np.save(f, embeddings)
+        os.replace(store_file + ".tmp{}".format(os.getpid()), store_file)
+
+        with open(header_file + ".tmp{}".format(os.getpid()), 'w') as f:
+            json.dump(header, f)
+        os.replace(header_file + ".tmp{}".format(os.getpid()), header_file)
+
+    def load_embedding_store(self, key, encoder):
+        # normalized embeddings of the patterns, titles and excerpts of one encoder, as a read-only memory-mapped .npy file
+        # the store is rebuilt when the encoder, the pattern corpus or the store format changes
+        header = self.embedding_store_header(key)
+
+        stored = None
+        if os.path.isfile(EMBEDDING_HEADER_FILE.format(key)) and os.path.isfile(EMBEDDING_STORE_FILE.format(key)):
+            with open(EMBEDDING_HEADER_FILE.format(key), 'r') as f:
+                stored = json.load(f)
+
+        if stored != header:
+            print("Building the pattern embeddings of", ENCODERS[key])
+            self.build_embedding_store(key, encoder, header)
+
+        # pages are shared by every process mapping the same file
+        return np.load(EMBEDDING_STORE_FILE.format(key), mmap_mode='r')
+
+    def encoder_id(self, key):
+        # cached embeddings of the int8 encoders are kept apart from the fp32 ones
+        return ENCODERS[key] + ("-int8" if self.quantize else "")
+
+    def encode_stories(self, key, encoder, all_story, cache=None):
+        # (len(all_story) x dim) float32 embeddings, every text missing from the cache is encoded once
+        # cache has lookup(model_name, text_hashes) -> {hash: bytes} and store(model_name, {hash: bytes})
+        hashes = [hashlib.sha256(story.encode('utf-8')).hexdigest() for story in all_story]
+
+        embeddings = {}
+        if cache is not None:
+            for h, embedding in cache.lookup(self.encoder_id(key), set(hashes)).items():
+                embeddings[h] = np.frombuffer(embedding, dtype=np.float32)
+
+        missing = {}
+        for h, story in zip(hashes, all_story):
+            if h not in embeddings and h not in missing:
+                missing[h] = story
+
+        if missing:
+            # sorted by length, so that every batch holds texts of similar length
+            order = sorted(missing, key=lambda h: len(missing[h]))
+            encoded = encoder.encode([missing[h] for h in order], convert_to_numpy=True).astype(np.float32)
+
+            for h, embedding in zip(order, encoded):
+                embeddings[h] = embedding
+
+            if cache is not None:
+                cache.store(self.encoder_id(key), {h: embeddings[h].tobytes() for h in order})
+
+        if not hashes:
+            return np.empty((0, encoder.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        return np.stack([embeddings[h] for h in hashes])
+
+    def semantic_features(self, texts, embedding_cache=None):
+        # cosine similarity of every text with the patterns, titles and excerpts for both encoders, (len(texts) x n_patterns x 6)
+        n = len(self.patterns)
+        semantic = np.zeros((len(texts), n, 6), dtype=np.float32)
+
+        for j, key in enumerate(ENCODERS):
+            if key not in self.encoders:
+                continue
+
+            story_emb = normalize_rows(self.encode_stories(key, self.encoders[key], texts, embedding_cache))
+
+            # one product gives the pattern, title and excerpt blocks, (len(texts) x 3 * n_patterns)
+            scores = story_emb @ self.pattern_embeddings[key].T
+            semantic[:, :, 3 * j:3 * j + 3] = scores.reshape(len(texts), 3, n).transpose(0, 2, 1)
+
+        return semantic
+
+    def quick_rank(self, text, k=5, embedding_cache=None):
+        # (indices, scores) of the top-k patterns of one text without the LTR model: the MiniLM cosine with the
+        # patterns (feature 21), or BM25 with the lexical feature set
+        if "minilm" in self.encoders:
+            story_emb = normalize_rows(self.encode_stories("minilm", self.encoders["minilm"], [text], embedding_cache))
+            scores = (story_emb @ self.pattern_embeddings["minilm"][:len(self.patterns)].T)[0]
         else:
-            self.precompute_pattern_embeddings()
-            
-    
-    def load_pattern_embeddings(self):
-        # Load the embeddings from the saved files
-        with open('LTR_resources/emb_pattern.pkl', 'rb') as f:
-            self.emb_pattern = pickle.load(f)
-            
-        with open('LTR_resources/emb_pattern_title.pkl', 'rb') as f:
-            self.emb_pattern_title = pickle.load(f)
-            
-        with open('LTR_resources/emb_pattern_excerpt.pkl', 'rb') as f:
-            self.emb_pattern_excerpt = pickle.load(f)
-            
-        with open('LTR_resources/emb_pattern_overflow.pkl', 'rb') as f:
-            self.emb_pattern_overflow = pickle.load(f)
-            
-        with open('LTR_resources/emb_pattern_title_overflow.pkl', 'rb') as f:
-            self.emb_pattern_title_overflow = pickle.load(f)
-            
-        with open('LTR_resources/emb_pattern_excerpt_overflow.pkl', 'rb') as f:
-            self.emb_pattern_excerpt_overflow = pickle.load(f)
-        
-    def precompute_pattern_embeddings(self):
-        # Compute embeddings for patterns
-        self.emb_pattern = self.model_sentence_transformer.encode(self.patterns, convert_to_tensor=True)
-        self.emb_pattern_title = self.model_sentence_transformer.encode(self.pattern_titles, convert_to_tensor=True)
-        self.emb_pattern_excerpt = self.model_sentence_transformer.encode(self.pattern_excerpts, convert_to_tensor=True)
-        
-        self.emb_pattern_overflow = self.model_sentence_transformer_overflow.encode(self.patterns, convert_to_tensor=True)
-        self.emb_pattern_title_overflow = self.model_sentence_transformer_overflow.encode(self.pattern_titles, convert_to_tensor=True)
-        self.emb_pattern_excerpt_overflow = self.model_sentence_transformer_overflow.encode(self.pattern_excerpts, convert_to_tensor=True)
+            scores = self.bm25_batch([text])[0]
 
-        # Save the embeddings for later use
-        with open('LTR_resources/emb_pattern.pkl', 'wb') as f:
-            pickle.dump(self.emb_pattern, f)
-            
-        with open('LTR_resources/emb_pattern_title.pkl', 'wb') as f:
-            pickle.dump(self.emb_pattern_title, f)
-            
-        with open('LTR_resources/emb_pattern_excerpt.pkl', 'wb') as f:
-            pickle.dump(self.emb_pattern_excerpt, f)
-            
-        with open('LTR_resources/emb_pattern_overflow.pkl', 'wb') as f:
-            pickle.dump(self.emb_pattern_overflow, f)
-            
-        with open('LTR_resources/emb_pattern_title_overflow.pkl', 'wb') as f:
-            pickle.dump(self.emb_pattern_title_overflow, f)
-            
-        with open('LTR_resources/emb_pattern_excerpt_overflow.pkl', 'wb') as f:
-            pickle.dump(self.emb_pattern_excerpt_overflow, f)
+        order = np.argsort(-scores, kind='stable')[:k]
 
+        return order, scores[order]
 
-    def construct_story_embeddings(self, all_story):
-        self.story_emb = self.model_sentence_transformer.encode(all_story, convert_to_tensor=True)
-        self.story_emb_overflow  = self.model_sentence_transformer_overflow.encode(all_story, convert_to_tensor=True)
-        
-        self.precompute_semantic_similarity_features()
-        
-    def construct_features(self, q, story_key):
-        q_words = word_tokenize(self.remove_stopwords(q))
+    def features_for(self, texts, embedding_cache=None):
+        # (len(texts) x n_patterns x 26) features, nothing is kept on the instance so concurrent requests can share it
+        semantic = self.semantic_features(texts, embedding_cache)
+        bm25_all, tf_idf_all = self.lexical_features(texts)
+
+        features = np.empty((len(texts), len(self.patterns), N_FEATURES))
+        for i, text in enumerate(texts):
+            features[i] = self.construct_features(text, semantic[i], bm25_all[i], tf_idf_all[i])
+
+        return features
+
+    def feature_version(self):
+        # changes with the pattern corpus and the encoders, stored feature blocks of another version are ignored
+        key = "-".join([self.corpus_fingerprint(), self.feature_set] + [self.encoder_id(key) for key in self.encoders])
+
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def construct_feature_blocks(self, texts, cache=None, embedding_cache=None):
+        # (len(texts) x n_patterns x 26) float32 features, computed once per unique text missing from the cache
+        # cache has lookup(corpus_version, schema_version, text_hashes) -> {hash: bytes} and store(corpus_version, schema_version, {hash: bytes})
+        hashes = [hashlib.sha256(text.encode('utf-8')).hexdigest() for text in texts]
+        version = self.feature_version()
+        shape = (len(self.patterns), N_FEATURES)
+
+        blocks = {}
+        if cache is not None:
+            for h, block in cache.lookup(version, FEATURE_SCHEMA_VERSION, set(hashes)).items():
+                blocks[h] = np.frombuffer(block, dtype=np.float32).reshape(shape)
+
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in blocks and h not in missing:
+                missing[h] = text
+
+        print("Generating Features for {} of {} requirements".format(len(missing), len(texts)))
+
+        if missing:
+            computed = self.features_for(list(missing.values()), embedding_cache).astype(np.float32)
+
+            for h, block in zip(missing, computed):
+                blocks[h] = block
+
+            if cache is not None:
+                cache.store(version, FEATURE_SCHEMA_VERSION, {h: blocks[h].tobytes() for h in missing})
+
+        features = np.empty((len(texts),) + shape, dtype=np.float32)
+        for i, h in enumerate(hashes):
+            features[i] = blocks[h]
+
+        return features
+
+    def construct_features(self, q, semantic, bm25=None, tf_idf_q=None):
+        # one row of 26 features per pattern
+        # semantic is the (n_patterns x 6) row of semantic_features() for q
+        # bm25 and tf_idf_q can be given from lexical_features() when many queries are processed
+        q_filtered = self.remove_stopwords(q)
+        q_words = word_tokenize(q_filtered)
 
         # we adapt the representation from MSLR-WEB dataset
         # q is query that represents the requirements
@@ -93,36 +253,31 @@ class PrivacyPatternFeatures(object):
         # each query have the pattern features
         # query level feature = when the parameter only contain q
 
-        len_q = len(self.remove_stopwords(q))
-        idf_q = self.get_idf(q_words)
-        tf_idf_q = self.tf_idf_features(q)
-        bm25 = self.bm25(q)
-
-        features_all = []
-        for i, pattern in enumerate(self.patterns):
-            features = []
-            features.extend(self.number_of_covered_words(q_words, pattern)) # 1, 2
-            features.append(len_q) # 3
-            features.append(idf_q) # 4
-            features.extend(self.tf_features(q_words, pattern)) # 5 - 14
-            features.extend(tf_idf_q) # 15 - 19
-            features.append(bm25[i]) # 20
-            features.append(float(self.cosine_scores_pattern[story_key][i])) # 21
-            features.append(float(self.cosine_scores_title[story_key][i])) # 22
-            features.append(float(self.cosine_scores_excerpt[story_key][i])) # 23
-            features.append(float(self.cosine_scores_pattern_overflow[story_key][i])) # 24
-            features.append(float(self.cosine_scores_title_overflow[story_key][i])) # 25
-            features.append(float(self.cosine_scores_excerpt_overflow[story_key][i])) # 26
-
-            # add information about category (unlinkability, transparency, etc) based on automatic classification
-
-            features_all.append(features)
+        len_q = len(q_filtered)
+        covered = self.covered_words(q_words)
+        idf_q = self.get_idf(q_words, covered)
+        if tf_idf_q is None:
+            tf_idf_q = self.tf_idf_features(q)
+
+        if bm25 is None:
+            bm25 = self.bm25(q)
+
+        features_all = np.empty((len(self.patterns), N_FEATURES))
+        features_all[:, 0:2] = self.number_of_covered_words_all(q_words, covered) # 1, 2
+        features_all[:, 2] = len_q # 3
+        features_all[:, 3] = idf_q # 4
+        features_all[:, 4:14] = self.tf_features_all(q_words) # 5 - 14
+        features_all[:, 14:19] = tf_idf_q # 15 - 19
+        features_all[:, 19] = bm25 # 20
+        features_all[:, 20:26] = semantic # 21 - 26, pattern, title and excerpt for MiniLM then for stackoverflow_mpnet
+
+        # add information about category (unlinkability, transparency, etc) based on automatic classification
 
         return features_all
             
 
     def get_corpus_pattern(self):
-        pattern_file= "LTR_resources/patterns.json"
+        pattern_file= PATTERN_FILE
         X = []
         title = []
         excerpt = []
@@ -155,26 +310,147 @@ class PrivacyPatternFeatures(object):
         return X, title, excerpt
     
     def get_lookup_patterns(self):
-        pattern_file= "LTR_resources/patterns.json"
-        pattern_dict = {}
-        
-        with open(pattern_file, 'r') as p:
-            patterns = json.loads(p.read())
-
-        for pattern in patterns:
-            title = pattern["filename"].replace(".md","")
-            pattern_dict[title] = pattern
-            
-        return pattern_dict
+        return get_lookup_patterns()
 
     def remove_stopwords(self, q):
-        stop_words = set(stopwords.words('english'))
         word_tokens = word_tokenize(q)
-        filtered_sentence = " ".join([w for w in word_tokens if not w.lower() in stop_words])
+        filtered_sentence = " ".join([w for w in word_tokens if not w.lower() in self.stop_words])
 
         return filtered_sentence
 
 
+    def corpus_fingerprint(self):
+        # changes with patterns.json, the index format or the nltk tokenizer
+        with open(PATTERN_FILE, 'rb') as p:
+            digest = hashlib.sha256(p.read()).hexdigest()
+
+        return "{}-{}-{}".format(digest, PATTERN_INDEX_VERSION, nltk.__version__)
+
+    def build_pattern_index(self, fingerprint):
+        pattern_tokens = [word_tokenize(pattern) for pattern in self.patterns]
+        pattern_lower = [pattern.lower() for pattern in self.patterns]
+
+        # a query word without whitespace is a substring of a pattern only inside one of its chunks
+        postings = {}
+        for i, text in enumerate(pattern_lower):
+            for chunk in set(text.split()):
+                postings.setdefault(chunk, []).append(i)
+
+        vocabulary = sorted(postings)
+
+        return {
+            "fingerprint" : fingerprint,
+            "tokens" : pattern_tokens,
+            "lower" : pattern_lower,
+            "vocabulary" : vocabulary,
+            "postings" : [np.array(postings[chunk], dtype=np.int64) for chunk in vocabulary],
+            "term_counts" : [Counter(tokens) for tokens in pattern_tokens],
+            "lengths" : [len(tokens) for tokens in pattern_tokens],
+            "stop_words" : set(stopwords.words('english')),
+        }
+
+    def initiate_pattern_index(self):
+        # the static corpus is tokenized once, then loaded from PATTERN_INDEX_FILE
+        fingerprint = self.corpus_fingerprint()
+
+        index = None
+        if os.path.isfile(PATTERN_INDEX_FILE):
+            # a truncated or corrupted index is rebuilt
+            try:
+                with open(PATTERN_INDEX_FILE, 'rb') as f:
+                    index = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError, ValueError):
+                index = None
+
+            if not isinstance(index, dict) or index.get("fingerprint") != fingerprint:
+                index = None
+
+        if index is None:
+            index = self.build_pattern_index(fingerprint)
+
+            # write to a temporary file first, a reader never sees a partial index
+            with open(PATTERN_INDEX_FILE + ".tmp{}".format(os.getpid()), 'wb') as f:
+                pickle.dump(index, f)
+            os.replace(PATTERN_INDEX_FILE + ".tmp{}".format(os.getpid()), PATTERN_INDEX_FILE)
+
+        self.pattern_tokens = index["tokens"]
+        self.pattern_lower = index["lower"]
+        self.pattern_term_counts = index["term_counts"]
+        self.pattern_lengths = np.array(index["lengths"])
+        self.stop_words = index["stop_words"]
+
+        self.vocabulary = index["vocabulary"]
+        self.postings = index["postings"]
+        # all the chunks in one string, searched with str.find, and the offset of every chunk in it
+        self.vocabulary_text = "\n".join(self.vocabulary)
+        self.vocabulary_offsets = np.cumsum([0] + [len(chunk) + 1 for chunk in self.vocabulary[:-1]]).tolist()
+        self.covering_cache = {}
+
+    def patterns_covering(self, word):
+        # ids of the patterns whose lowercase text contains the lowercase word
+        # a single get, another thread may empty the cache at any time
+        ids = self.covering_cache.get(word)
+        if ids is not None:
+            return ids
+
+        if not word or any(c.isspace() for c in word):
+            ids = np.array([i for i, pattern in enumerate(self.pattern_lower) if word in pattern], dtype=np.int64)
+        else:
+            chunks = []
+            start = self.vocabulary_text.find(word)
+            while start != -1:
+                k = bisect_right(self.vocabulary_offsets, start) - 1
+                chunks.append(k)
+
+                # continue from the next chunk, one match per chunk is enough
+                if k + 1 == len(self.vocabulary_offsets):
+                    break
+                start = self.vocabulary_text.find(word, self.vocabulary_offsets[k + 1])
+
+            ids = np.unique(np.concatenate([self.postings[k] for k in chunks])) if chunks else np.empty(0, dtype=np.int64)
+
+        if len(self.covering_cache) >= COVERING_CACHE_SIZE:
+            self.covering_cache.clear()
+        self.covering_cache[word] = ids
+
+        return ids
+
+    def initiate_term_counts(self):
+        # token counts of every pattern as an (n_patterns x n_tokens) matrix, tokens are kept as word_tokenize returns them
+        self.term_index = {}
+        rows, cols, counts = [], [], []
+        for i, term_counts in enumerate(self.pattern_term_counts):
+            for token, count in term_counts.items():
+                rows.append(i)
+                cols.append(self.term_index.setdefault(token, len(self.term_index)))
+                counts.append(count)
+
+        self.term_counts = sparse.csc_matrix((np.array(counts, dtype=np.int64), (rows, cols)), shape=(len(self.patterns), len(self.term_index)))
+
+    def query_term_counts(self, q_words):
+        # (n_patterns x len(q_words)) counts of each query word in each pattern
+        counts = np.zeros((len(self.patterns), len(q_words)), dtype=np.int64)
+
+        known = [j for j, word in enumerate(q_words) if word in self.term_index]
+        if known:
+            counts[:, known] = self.term_counts[:, [self.term_index[q_words[j]] for j in known]].toarray()
+
+        return counts
+
+    def covered_words(self, q_words):
+        # (n_patterns x len(q_words)) True where the lowercase word is a substring of the lowercase pattern
+        covered = np.zeros((len(self.patterns), len(q_words)), dtype=bool)
+
+        columns = {}
+        for j, word in enumerate(q_words):
+            word = word.lower()
+            if word not in columns:
+                columns[word] = self.patterns_covering(word)
+
+            covered[columns[word], j] = True
+
+        return covered
+
     def initiate_tf_idf(self):
         self.tf_idf_vectorizer = TfidfVectorizer(norm=None, smooth_idf=False)
         self.tf_idf_vectorizer.fit(self.patterns)
@@ -185,29 +461,42 @@ class PrivacyPatternFeatures(object):
         self.b = b
         self.k1 = k1
 
-        y = super(TfidfVectorizer, self.tf_idf_vectorizer).transform(self.patterns)
-        self.avdl = y.sum(1).mean()
-
+        # apply CountVectorizer once, the corpus never changes
+        X = super(TfidfVectorizer, self.tf_idf_vectorizer).transform(self.patterns).tocoo()
+        self.doc_lengths = np.asarray(X.sum(1)).ravel()
+        self.avdl = self.doc_lengths.mean()
 
-    def bm25(self, q):
-        X = self.patterns
-        """ Calculate BM25 between query q and documents X """
-        b, k1, avdl = self.b, self.k1, self.avdl
-
-        # apply CountVectorizer
-        X = super(TfidfVectorizer, self.tf_idf_vectorizer).transform(X)
-        len_X = X.sum(1).A1
-        q, = super(TfidfVectorizer, self.tf_idf_vectorizer).transform([q])
-        assert sparse.isspmatrix_csr(q)
-
-        # convert to csc for better column slicing
-        X = X.tocsc()[:, q.indices]
-        denom = X + (k1 * (1 - b + b * len_X / avdl))[:, None]
         # idf(t) = log [ n / df(t) ] + 1 in sklearn, so it need to be coneverted
         # to idf(t) = log [ n / df(t) ] with minus 1
-        idf = self.tf_idf_vectorizer._tfidf.idf_[None, q.indices] - 1.
-        numer = X.multiply(np.broadcast_to(idf, X.shape)) * (k1 + 1)                                                          
-        return (numer / denom).sum(1).A1
+        self.bm25_idf = self.tf_idf_vectorizer._tfidf.idf_ - 1.
+
+        # BM25 weight of every (pattern, term) pair, the score of a query is the sum of the weights of its terms
+        denom = X.data + (k1 * (1 - b + b * self.doc_lengths / self.avdl))[X.row]
+        numer = X.data * self.bm25_idf[X.col] * (k1 + 1)
+        self.bm25_weights = sparse.csr_matrix((numer / denom, (X.row, X.col)), shape=X.shape)
+
+    def lexical_features(self, queries):
+        # BM25 (n_queries x n_patterns) and TF-IDF summary (n_queries x 5) of many queries, with one transform
+        if len(queries) == 0:
+            return np.empty((0, len(self.patterns))), np.empty((0, 5))
+
+        tf_idf = self.tf_idf_vectorizer.transform(queries)
+
+        return self.bm25_batch(queries, tf_idf), self.tf_idf_features_batch(queries, tf_idf)
+
+    def bm25_batch(self, queries, tf_idf=None):
+        """ Calculate BM25 between every query and the patterns """
+        if tf_idf is None:
+            tf_idf = self.tf_idf_vectorizer.transform(queries)
+
+        # every term of a query counts once, whatever its frequency in the query
+        terms = tf_idf.copy()
+        terms.data[:] = 1.
+
+        return (terms @ self.bm25_weights.T).toarray()
+
+    def bm25(self, q):
+        return self.bm25_batch([q])[0]
 
     def number_of_covered_words(self, q_words, pattern):
         # How many terms in the user query are covered by the text.
@@ -221,15 +510,18 @@ class PrivacyPatternFeatures(object):
         ratio = n/len(q_words)
         return [n, ratio]
 
-    def get_idf(self, q_words):
+    def number_of_covered_words_all(self, q_words, covered):
+        # number_of_covered_words for all the patterns, as an (n_patterns x 2) matrix
+        n = covered.sum(axis=1)
+
+        return np.column_stack((n, n / len(q_words)))
+
+    def get_idf(self, q_words, covered=None):
         # 1 divided by the number of documents containing the query terms.
+        if covered is None:
+            covered = self.covered_words(q_words)
 
-        n = 0
-        word_in_patterns = set()
-        for pattern in self.patterns:
-            for word in q_words:
-                if word.lower() in pattern.lower():
-                    word_in_patterns.add(word.lower())
+        word_in_patterns = set(word.lower() for j, word in enumerate(q_words) if covered[:, j].any())
 
         idf = 1/len(list(word_in_patterns))
 
@@ -250,25 +542,33 @@ class PrivacyPatternFeatures(object):
         return [tf_sum, tf_min, tf_max, tf_avg, tf_var, norm_tf_sum, norm_tf_min, norm_tf_max, norm_tf_avg, norm_tf_var]
 
 
-    def tf_idf_features(self, q):
-        tfidf_matrix= self.tf_idf_vectorizer.transform([q]).todense()
-        feature_index = tfidf_matrix[0,:].nonzero()[1]
-        tfidf_scores = zip([self.tf_idf_feature_names[i] for i in feature_index], [tfidf_matrix[0, x] for x in feature_index])
+    def tf_features_all(self, q_words):
+        # tf_features for all the patterns, as an (n_patterns x 10) matrix
+        n_count_all = self.query_term_counts(q_words)
+        total_len = self.pattern_lengths
+
+        tf_sum, tf_min, tf_max, tf_avg, tf_var = n_count_all.sum(axis=1), n_count_all.min(axis=1), n_count_all.max(axis=1), np.average(n_count_all, axis=1), np.var(n_count_all, axis=1)
+
+        return np.column_stack((tf_sum, tf_min, tf_max, tf_avg, tf_var, tf_sum/total_len, tf_min/total_len, tf_max/total_len, tf_avg/total_len, tf_var/total_len))
 
-        word_scores = [score for score in dict(tfidf_scores).values()]
+    def tf_idf_features_batch(self, queries, tf_idf=None):
+        # Sum, Min, Max, Average, Variance of the tf-idf of the query terms, one row per query
+        if tf_idf is None:
+            tf_idf = self.tf_idf_vectorizer.transform(queries)
 
-        tfidf_sum, tfidf_min, tfidf_max, tfidf_avg, tfidf_var = sum(word_scores), min(word_scores), max(word_scores), np.average(word_scores), np.var(word_scores)
+        tf_idf = tf_idf.tocsr()
+        tf_idf.sort_indices()
 
-        return [tfidf_sum, tfidf_min, tfidf_max, tfidf_avg, tfidf_var]
+        features = np.empty((tf_idf.shape[0], 5))
+        for i in range(tf_idf.shape[0]):
+            word_scores = list(tf_idf.data[tf_idf.indptr[i]:tf_idf.indptr[i + 1]])
 
-    def precompute_semantic_similarity_features(self):
-        self.cosine_scores_pattern = util.cos_sim(self.story_emb, self.emb_pattern)
-        self.cosine_scores_title = util.cos_sim(self.story_emb, self.emb_pattern_title)
-        self.cosine_scores_excerpt = util.cos_sim(self.story_emb, self.emb_pattern_excerpt)
+            features[i] = [sum(word_scores), min(word_scores), max(word_scores), np.average(word_scores), np.var(word_scores)]
 
-        self.cosine_scores_pattern_overflow = util.cos_sim(self.story_emb_overflow, self.emb_pattern_overflow)
-        self.cosine_scores_title_overflow = util.cos_sim(self.story_emb_overflow, self.emb_pattern_title_overflow)
-        self.cosine_scores_excerpt_overflow = util.cos_sim(self.story_emb_overflow, self.emb_pattern_excerpt_overflow)
+        return features
+
+    def tf_idf_features(self, q):
+        return list(self.tf_idf_features_batch([q])[0])
 
 # pp = PrivacyPatternFeatures()
 # features = pp.construct_features("Location personal data")
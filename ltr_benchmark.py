@@ -0,0 +1,142 @@
+import argparse
+import gc
+import json
+import time
+import numpy as np
+from feature_engineering import PrivacyPatternFeatures, FEATURE_SETS
+from model_registry import resident_memory
+from pattern_catalog import get_lookup_patterns
+from ranklib import RankBoostScorer, RANKBOOST_MODEL_PATH
+'''
+Compare the LTR feature sets (full, minilm, lexical) on validated requirement/pattern pairs:
+
+    python ltr_benchmark.py qrels.json
+    python ltr_benchmark.py --from-db
+
+qrels.json is a list of validated requirements with their relevant patterns (pattern keys, the
+filenames of patterns.json without .md):
+
+    [{"requirement": "The system shall ...", "patterns": ["anonymity-set", "pseudonymous-identity"]}, ...]
+
+--from-db reads the same pairs from the database of the web app: the validated requirements and
+requirement groups with the privacy patterns linked to them (RequirementsPatterns and
+RequirementGroupsPatterns). A PrivacyPattern row is matched to its pattern key by its summary, the
+excerpt of the pattern in patterns.json.
+
+For every feature set it reports the load time and memory of PrivacyPatternFeatures, the latency of
+the semantic features (encoding) and of all the features per requirement, and the NDCG@5 of the
+RankBoost ranking. The RankBoost model is the one trained on the full feature set.
+'''
+
+
+def read_qrels(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        qrels = json.load(f)
+
+    return [q["requirement"] for q in qrels], [set(q["patterns"]) for q in qrels]
+
+
+def read_qrels_from_db():
+    from app import app
+    from model import db, Requirements, RequirementGroup, RequirementsPatterns, RequirementGroupsPatterns, PrivacyPattern
+
+    pattern_keys = {pattern["excerpt"].strip(): key for key, pattern in get_lookup_patterns().items()}
+
+    # (requirement, link table, its requirement column), the requirement groups are separate queries
+    sources = [
+        (Requirements, RequirementsPatterns, RequirementsPatterns.requirement_id),
+        (RequirementGroup, RequirementGroupsPatterns, RequirementGroupsPatterns.requirement_group_id),
+    ]
+
+    texts, relevant = [], []
+    unknown = set()
+    with app.app_context():
+        for requirement, link, link_requirement_id in sources:
+            rows = db.session.query(requirement.id, requirement.req_text, PrivacyPattern.summary) \
+                .join(link, link_requirement_id==requirement.id) \
+                .join(PrivacyPattern, PrivacyPattern.id==link.privacy_pattern_id) \
+                .filter(requirement.valid=="yes") \
+                .order_by(requirement.id).all()
+
+            qrels = {}
+            for requirement_id, req_text, summary in rows:
+                key = pattern_keys.get((summary or "").strip())
+                if key is None:
+                    unknown.add(summary)
+                    continue
+
+                qrels.setdefault(requirement_id, (req_text, set()))[1].add(key)
+
+            for req_text, patterns in qrels.values():
+                texts.append(req_text)
+                relevant.append(patterns)
+
+    if unknown:
+        print("{} privacy patterns of the database are not in patterns.json, skipped".format(len(unknown)))
+
+    return texts, relevant
+
+
+def ndcg_at_k(ranked_keys, relevant, k=5):
+    # binary relevance
+    dcg = sum(1 / np.log2(i + 2) for i, key in enumerate(ranked_keys[:k]) if key in relevant)
+    idcg = sum(1 / np.log2(i + 2) for i in range(min(k, len(relevant))))
+
+    return dcg / idcg if idcg > 0 else 0.0
+
+
+def evaluate(feature_set, texts, relevant, ranker, quantize, k):
+    gc.collect()
+    rss_before = resident_memory()
+    start = time.perf_counter()
+
+    pp = PrivacyPatternFeatures(quantize=quantize, feature_set=feature_set)
+
+    load_time = time.perf_counter() - start
+    memory = max(resident_memory() - rss_before, 0)
+
+    start = time.perf_counter()
+    pp.semantic_features(texts)
+    encode_latency = time.perf_counter() - start
+
+    start = time.perf_counter()
+    features = pp.features_for(texts)
+    feature_latency = time.perf_counter() - start
+
+    pattern_keys = [title.replace(" ", "-") for title in pp.pattern_titles]
+    order = ranker.rank(ranker.score(features))
+    ndcg = np.mean([ndcg_at_k([pattern_keys[i] for i in query_order], query_relevant, k) for query_order, query_relevant in zip(order, relevant)])
+
+    del pp, features
+
+    return load_time, memory, encode_latency, feature_latency, ndcg
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the latency, memory and ranking quality of the LTR feature sets")
+    parser.add_argument("qrels", nargs="?", help="JSON list of {requirement, patterns}")
+    parser.add_argument("--from-db", action="store_true", help="read the qrels from the database of the web app instead")
+    parser.add_argument("--feature-sets", nargs="+", default=list(FEATURE_SETS), choices=list(FEATURE_SETS))
+    parser.add_argument("--model", default=RANKBOOST_MODEL_PATH)
+    parser.add_argument("--quantize", action="store_true", help="int8 sentence encoders")
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+    if (args.qrels is None) == (not args.from_db):
+        parser.error("give either a qrels file or --from-db")
+
+    texts, relevant = read_qrels_from_db() if args.from_db else read_qrels(args.qrels)
+    if not texts:
+        parser.error("no validated requirement with a linked privacy pattern")
+    ranker = RankBoostScorer.load(args.model)
+    print("{} requirements".format(len(texts)))
+
+    print("{:<8} {:>10} {:>12} {:>14} {:>16} {:>10}".format("set", "load (s)", "memory (MB)", "encode (ms)", "features (ms)", "NDCG@{}".format(args.k)))
+    for feature_set in args.feature_sets:
+        load_time, memory, encode_latency, feature_latency, ndcg = evaluate(feature_set, texts, relevant, ranker, args.quantize, args.k)
+        print("{:<8} {:>10.2f} {:>12.1f} {:>14.2f} {:>16.2f} {:>10.4f}".format(feature_set, load_time, memory / 2**20, 1000 * encode_latency / len(texts), 1000 * feature_latency / len(texts), ndcg))
+
+    print("\nlatency is per requirement, features includes the encoding")
+
+
+if __name__ == "__main__":
+    main()
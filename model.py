@@ -1,8 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from rdflib import Graph, Namespace, Literal, URIRef, BNode, RDFS
 from rdflib.namespace import RDF, RDFS, OWL, FOAF
 from datetime import datetime
 from flask_login import current_user
+import json
 
 # default ns
 ns = Namespace("http://www.privacystory.org/ontology#")
@@ -25,6 +28,11 @@ g.bind('msc', MSC)
 
 db = SQLAlchemy()
 
+def insert_ignoring_duplicates(model, rows):
+  # rows are dicts of the columns, the rows whose unique key is already stored (e.g. by a concurrent request) are skipped, the caller commits
+  if rows:
+    db.session.execute(sqlite_insert(model.__table__).on_conflict_do_nothing(), rows)
+
 fictional_project_description = """
 Our solution, Camper+, aims to revolutionize camp management by providing you and your customers with the necessary resources to streamline and enhance the camp experience. Camper+ serves as the ultimate toolkit for camp administrators, offering a comprehensive range of tools to simplify the camp setup process. By utilizing Camper+, administrators can efficiently handle tasks ranging from registration to creating nametags. Unlike traditional methods that often involve multiple external sources, Camper+ consolidates all the required information into a single user-friendly platform.
 
@@ -238,6 +246,121 @@ class Entities(db.Model):
   def __repr__(self):
     return "Entitiy "%r" Created" % label
 
+class NerCache(db.Model):
+  # NER spans of a story text, valid for one model fingerprint only
+  id = db.Column(db.Integer, primary_key=True)
+  text_hash = db.Column(db.String(64), nullable=False)
+  model_fingerprint = db.Column(db.String(64), nullable=False)
+  spans = db.Column(db.Text, nullable=False)
+
+  __table_args__ = (db.Index('ix_ner_cache_key', 'text_hash', 'model_fingerprint', unique=True),)
+
+  def __init__(self, text_hash, model_fingerprint, spans):
+    self.text_hash = text_hash
+    self.model_fingerprint = model_fingerprint
+    self.spans = json.dumps([list(span) for span in spans])
+
+  @classmethod
+  def lookup(cls, model_fingerprint, text_hashes):
+    # text hash -> list of [start, end, text, label, score]
+    text_hashes = list(text_hashes)
+    cached = {}
+
+    # keep the IN clause under the sqlite variable limit
+    for i in range(0, len(text_hashes), 500):
+      rows = cls.query.filter(cls.model_fingerprint==model_fingerprint, cls.text_hash.in_(text_hashes[i:i + 500])).all()
+      for row in rows:
+        cached[row.text_hash] = json.loads(row.spans)
+
+    return cached
+
+  @classmethod
+  def store(cls, model_fingerprint, spans):
+    # spans is text hash -> list of NerSpan, the caller commits
+    insert_ignoring_duplicates(cls, [{"text_hash": text_hash, "model_fingerprint": model_fingerprint, "spans": json.dumps([list(span) for span in text_spans])} for text_hash, text_spans in spans.items()])
+
+class EmbeddingCache(db.Model):
+  # sentence embedding (float32 bytes) of a requirement text, for one encoder
+  id = db.Column(db.Integer, primary_key=True)
+  text_hash = db.Column(db.String(64), nullable=False)
+  model_name = db.Column(db.String(200), nullable=False)
+  embedding = db.Column(db.LargeBinary, nullable=False)
+
+  __table_args__ = (db.Index('ix_embedding_cache_key', 'text_hash', 'model_name', unique=True),)
+
+  def __init__(self, text_hash, model_name, embedding):
+    self.text_hash = text_hash
+    self.model_name = model_name
+    self.embedding = embedding
+
+  @classmethod
+  def lookup(cls, model_name, text_hashes):
+    # text hash -> embedding bytes
+    text_hashes = list(text_hashes)
+    cached = {}
+
+    # keep the IN clause under the sqlite variable limit
+    for i in range(0, len(text_hashes), 500):
+      rows = cls.query.filter(cls.model_name==model_name, cls.text_hash.in_(text_hashes[i:i + 500])).all()
+      for row in rows:
+        cached[row.text_hash] = row.embedding
+
+    return cached
+
+  @classmethod
+  def store(cls, model_name, embeddings):
+    # embeddings is text hash -> embedding bytes, the caller commits
+    insert_ignoring_duplicates(cls, [{"text_hash": text_hash, "model_name": model_name, "embedding": embedding} for text_hash, embedding in embeddings.items()])
+
+class LtrFeatureBlock(db.Model):
+  # LTR features (n_patterns x 26 float32 bytes) of a requirement text against the whole pattern corpus
+  id = db.Column(db.Integer, primary_key=True)
+  text_hash = db.Column(db.String(64), nullable=False)
+  corpus_version = db.Column(db.String(64), nullable=False)
+  schema_version = db.Column(db.Integer, nullable=False)
+  features = db.Column(db.LargeBinary, nullable=False)
+
+  __table_args__ = (db.Index('ix_ltr_feature_block_key', 'text_hash', 'corpus_version', 'schema_version', unique=True),)
+
+  def __init__(self, text_hash, corpus_version, schema_version, features):
+    self.text_hash = text_hash
+    self.corpus_version = corpus_version
+    self.schema_version = schema_version
+    self.features = features
+
+  @classmethod
+  def lookup(cls, corpus_version, schema_version, text_hashes):
+    # text hash -> feature bytes
+    text_hashes = list(text_hashes)
+    cached = {}
+
+    # keep the IN clause under the sqlite variable limit
+    for i in range(0, len(text_hashes), 500):
+      rows = cls.query.filter(cls.corpus_version==corpus_version, cls.schema_version==schema_version, cls.text_hash.in_(text_hashes[i:i + 500])).all()
+      for row in rows:
+        cached[row.text_hash] = row.features
+
+    return cached
+
+  @classmethod
+  def store(cls, corpus_version, schema_version, blocks):
+    # blocks is text hash -> feature bytes, the caller commits
+    # the blocks of another corpus or schema version are never read again
+    cls.query.filter(db.or_(cls.corpus_version!=corpus_version, cls.schema_version!=schema_version)).delete(synchronize_session=False)
+
+    insert_ignoring_duplicates(cls, [{"text_hash": text_hash, "corpus_version": corpus_version, "schema_version": schema_version, "features": features} for text_hash, features in blocks.items()])
+
+def create_cache_indexes():
+  # create_all does not add indexes to existing tables, a cache holding duplicate keys is emptied first
+  for model in (NerCache, EmbeddingCache, LtrFeatureBlock):
+    for index in model.__table__.indexes:
+      try:
+        index.create(db.engine, checkfirst=True)
+      except IntegrityError:
+        model.query.delete()
+        db.session.commit()
+        index.create(db.engine, checkfirst=True)
+
 class Dfd(db.Model):
   id = db.Column(db.Integer, primary_key=True)
   project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
@@ -566,6 +689,34 @@ class RequirementGroup(db.Model):
     g.add((requirement_individual, ns.req_text, Literal(self.req_text)))
 
     return g.serialize(format='turtle')
+
+class PatternRecommendation(db.Model):
+  # ranked privacy patterns of a requirement, or of a requirement group, rank 1 is the best pattern
+  id = db.Column(db.Integer, primary_key=True)
+  requirement_id = db.Column(db.Integer, db.ForeignKey('requirements.id'), nullable=True, index=True)
+  requirement_group_id = db.Column(db.Integer, db.ForeignKey('requirement_group.id'), nullable=True, index=True)
+  rank = db.Column(db.Integer, nullable=False)
+  pattern_key = db.Column(db.String(255), nullable=False)
+  score = db.Column(db.Float, nullable=False)
+  date_created = db.Column(db.DateTime, default=datetime.utcnow)
+
+  @classmethod
+  def top(cls, requirement_id=None, requirement_group_id=None, k=5):
+    query = cls.query.filter(cls.requirement_id==requirement_id) if requirement_id is not None else cls.query.filter(cls.requirement_group_id==requirement_group_id)
+
+    return query.order_by(cls.rank).limit(k).all()
+
+  @classmethod
+  def replace(cls, requirement_ids, requirement_group_ids, rows):
+    # rows are dicts of the columns, the previous recommendations of the requirements are removed, the caller commits
+    # keep the IN clause under the sqlite variable limit
+    for i in range(0, len(requirement_ids), 500):
+      cls.query.filter(cls.requirement_id.in_(requirement_ids[i:i + 500])).delete(synchronize_session=False)
+
+    for i in range(0, len(requirement_group_ids), 500):
+      cls.query.filter(cls.requirement_group_id.in_(requirement_group_ids[i:i + 500])).delete(synchronize_session=False)
+
+    db.session.bulk_insert_mappings(cls, rows)
       
 class LogAction(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -0,0 +1,222 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+'''
+Process-wide registry of the NLP models used by PrivacyStory.
+Every model is loaded lazily, once per process, and the same object is handed
+out to app.py (refresh_ner), StoryDFD and the "so that" parser.
+The registry keeps the load time and resident memory of every model, and can
+warm the models up on a background thread so the web app answers requests
+that do not need them while they load.
+
+With configure(quantize=True), the Flair taggers and the sentence encoders are
+served with dynamic int8 quantization of their linear layers (CPU only).
+Use quantization_benchmark.py to compare them with the fp32 models first.
+'''
+
+NER_MODEL_PATH = "static/model/ner-model-roberta-aug-mr-jean-baptiste.pt"
+SO_THAT_NER_MODEL_PATH = "static/model/ner-model.pt"
+SPACY_MODEL = "en_core_web_sm"
+# only dep_, pos_, tag_ and head are read from the parses
+SPACY_EXCLUDE = ["ner", "lemmatizer"]
+
+_models = {}
+_model_stats = {}
+_model_fingerprints = {}
+_model_errors = {}
+_warmup_thread = None
+
+# inference options, set them with configure() before any model is loaded
+QUANTIZE = False
+# LTR feature set, see FEATURE_SETS in feature_engineering.py
+FEATURE_SET = "full"
+_model_locks = {}
+_registry_lock = threading.Lock()
+
+
+def resident_memory():
+    # resident set size of the current process, in bytes
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _get_lock(name):
+    with _registry_lock:
+        if name not in _model_locks:
+            _model_locks[name] = threading.Lock()
+
+        return _model_locks[name]
+
+
+def configure(quantize=None, feature_set=None):
+    global QUANTIZE, FEATURE_SET
+
+    if quantize is not None:
+        QUANTIZE = bool(quantize)
+
+    if feature_set is not None:
+        FEATURE_SET = feature_set
+
+
+def quantize_dynamic_int8(module):
+    # int8 weights for every nn.Linear, activations are quantized on the fly
+    import torch
+    return torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def file_fingerprint(path):
+    # identifies a model file by its location, size and modification time
+    stat = os.stat(path)
+    key = "{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+def load_model(name, loader, model_path=None):
+    # return the model registered under name, calling loader() the first time only
+    if name in _models:
+        return _models[name]
+
+    with _get_lock(name):
+        if name not in _models:
+            logging.info('Loading model %s', name)
+
+            rss_before = resident_memory()
+            start = time.perf_counter()
+
+            try:
+                model = loader()
+            except Exception as e:
+                _model_errors[name] = str(e)
+                raise
+
+            _model_stats[name] = {
+                "load_seconds" : time.perf_counter() - start,
+                "rss_bytes" : max(resident_memory() - rss_before, 0),
+            }
+            fingerprint = file_fingerprint(model_path) if model_path else None
+            if fingerprint and QUANTIZE:
+                # quantized predictions are cached apart from the fp32 ones
+                fingerprint += "-int8"
+
+            _model_fingerprints[name] = fingerprint
+            _model_errors.pop(name, None)
+            _models[name] = model
+
+            logging.info('Model %s loaded in %.2fs, %.1f MB resident', name, _model_stats[name]["load_seconds"], _model_stats[name]["rss_bytes"] / 2**20)
+
+    return _models[name]
+
+
+def is_loaded(name):
+    return name in _models
+
+
+def model_fingerprint(name):
+    # changes whenever the file behind a loaded model changes, used to invalidate cached predictions
+    return _model_fingerprints.get(name)
+
+
+def model_stats():
+    # load time (seconds) and resident memory delta (bytes) of every loaded model
+    return {name: dict(stats) for name, stats in _model_stats.items()}
+
+
+def _load_tagger(path):
+    from flair.models import SequenceTagger
+    tagger = SequenceTagger.load(path)
+
+    if QUANTIZE:
+        tagger = quantize_dynamic_int8(tagger.eval())
+
+    return tagger
+
+
+def _load_spacy(model_name, exclude=()):
+    import spacy
+    return spacy.load(model_name, exclude=list(exclude))
+
+
+def get_ner_model():
+    # Flair tagger for PII, Data (subject) and Processing entities
+    return load_model("ner", lambda: _load_tagger(NER_MODEL_PATH), NER_MODEL_PATH)
+
+
+def get_so_that_ner_model():
+    # Flair tagger used when parsing the "so that" part of the stories
+    return load_model("ner_so_that", lambda: _load_tagger(SO_THAT_NER_MODEL_PATH), SO_THAT_NER_MODEL_PATH)
+
+
+def get_nlp():
+    # tagger and parser of en_core_web_sm, without the components the code never reads
+    return load_model("spacy", lambda: _load_spacy(SPACY_MODEL, SPACY_EXCLUDE))
+
+
+def get_pattern_features():
+    # learning-to-rank features, loads the sentence encoders of the feature set and the pattern embeddings
+    def load():
+        from feature_engineering import PrivacyPatternFeatures
+        return PrivacyPatternFeatures(quantize=QUANTIZE, feature_set=FEATURE_SET)
+
+    return load_model("pattern_features", load)
+
+
+def get_ranker():
+    # RankBoost model of the pattern recommendation, scored in-process
+    from ranklib import RankBoostScorer, RANKBOOST_MODEL_PATH
+    return load_model("ranker", lambda: RankBoostScorer.load(RANKBOOST_MODEL_PATH), RANKBOOST_MODEL_PATH)
+
+
+# models warmed up at boot, in this order
+WARMUP_MODELS = {
+    "ner" : get_ner_model,
+    "spacy" : get_nlp,
+    "ner_so_that" : get_so_that_ner_model,
+    "pattern_features" : get_pattern_features,
+    "ranker" : get_ranker,
+}
+
+
+def _warm_up(names):
+    for name in names:
+        try:
+            WARMUP_MODELS[name]()
+        except Exception:
+            logging.exception('Warm-up of model %s failed', name)
+
+
+def start_warmup(names=None):
+    # load the models on a daemon thread, requests needing a model wait for it
+    global _warmup_thread
+
+    if _warmup_thread is None:
+        _warmup_thread = threading.Thread(target=_warm_up, args=(list(names or WARMUP_MODELS),), name="model-warmup", daemon=True)
+        _warmup_thread.start()
+
+    return _warmup_thread
+
+
+def model_status():
+    # loaded / loading / failed / pending for every known model
+    status = {}
+    for name in WARMUP_MODELS:
+        if name in _models:
+            status[name] = "loaded"
+        elif name in _model_errors:
+            status[name] = "failed"
+        elif name in _model_locks and _model_locks[name].locked():
+            status[name] = "loading"
+        else:
+            status[name] = "pending"
+
+    return status
+
+
+def is_ready():
+    return all(name in _models for name in WARMUP_MODELS)
@@ -0,0 +1,70 @@
+import hashlib
+from collections import namedtuple
+from flask import has_app_context
+'''
+Batched NER inference over many stories at once.
+The stories are sorted by their number of tokens so that every mini-batch
+holds sentences of similar length (little padding), and the predicted spans
+are returned in the original order of the stories.
+
+When a model fingerprint is given and a database is available, the spans are
+cached in the NerCache table, keyed by the hash of the story text. Unchanged
+stories are never tagged twice, and a new model file gives a new fingerprint.
+'''
+
+DEFAULT_MINI_BATCH_SIZE = 32
+
+# one predicted entity, positions are character offsets in the story
+NerSpan = namedtuple('NerSpan', ['start', 'end', 'text', 'label', 'score'])
+
+
+def span_from_flair(span):
+    label = span.get_label("ner")
+    return NerSpan(span.start_position, span.end_position, span.text, label.value, label.score)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def length_buckets(sentences, mini_batch_size):
+    # indices of the sentences, grouped in mini-batches of similar length
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+
+    return [order[i:i + mini_batch_size] for i in range(0, len(order), mini_batch_size)]
+
+
+def predict_spans(stories, model, mini_batch_size=DEFAULT_MINI_BATCH_SIZE):
+    # run the tagger on every story, without any cache
+    from flair.data import Sentence
+    sentences = [Sentence(story) for story in stories]
+
+    for bucket in length_buckets(sentences, mini_batch_size):
+        model.predict([sentences[i] for i in bucket], mini_batch_size=mini_batch_size)
+
+    return [[span_from_flair(span) for span in sentence.get_spans('ner')] for sentence in sentences]
+
+
+def tag_stories(stories, model, mini_batch_size=DEFAULT_MINI_BATCH_SIZE, fingerprint=None):
+    # returns one list of NerSpan per story, new cache rows are committed by the caller
+    if fingerprint is None or not has_app_context():
+        return predict_spans(stories, model, mini_batch_size)
+
+    from model import NerCache
+
+    hashes = [text_hash(story) for story in stories]
+    cached = NerCache.lookup(fingerprint, set(hashes))
+
+    # tag every missing text once, even if several stories share it
+    missing = {}
+    for h, story in zip(hashes, stories):
+        if h not in cached and h not in missing:
+            missing[h] = story
+
+    if missing:
+        predicted = dict(zip(missing.keys(), predict_spans(list(missing.values()), model, mini_batch_size)))
+
+        NerCache.store(fingerprint, predicted)
+        cached.update(predicted)
+
+    return [[NerSpan(*span) for span in cached[h]] for h in hashes]
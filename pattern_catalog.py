@@ -0,0 +1,21 @@
+import json
+'''
+The privacy patterns of privacypatterns.org (LTR_resources/patterns.json), without any model or NLP dependency,
+so the web app can read them at import. feature_engineering.py builds the LTR features on top of the same file.
+'''
+
+PATTERN_FILE = "LTR_resources/patterns.json"
+
+
+def get_lookup_patterns():
+    # pattern key (filename without .md) -> pattern, does not need any model
+    pattern_dict = {}
+
+    with open(PATTERN_FILE, 'r') as p:
+        patterns = json.loads(p.read())
+
+    for pattern in patterns:
+        title = pattern["filename"].replace(".md","")
+        pattern_dict[title] = pattern
+
+    return pattern_dict
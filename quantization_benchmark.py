@@ -0,0 +1,120 @@
+import argparse
+import gc
+import time
+import numpy as np
+from flair.models import SequenceTagger
+from sentence_transformers import SentenceTransformer
+from model_registry import NER_MODEL_PATH, quantize_dynamic_int8, resident_memory
+from ner_inference import predict_spans
+'''
+Compare the int8 (dynamic quantization) models with the fp32 ones on a held-out
+story file, one user story per line:
+
+    python quantization_benchmark.py held_out_stories.txt
+
+For the NER tagger it reports latency, memory and the entity F1 of the int8
+predictions against the fp32 predictions. For the sentence encoders it reports
+latency, memory and the cosine drift between the fp32 and int8 embeddings.
+Memory is the growth of the resident set size while loading the model.
+'''
+
+ENCODERS = ['all-MiniLM-L6-v2', 'flax-sentence-embeddings/stackoverflow_mpnet-base']
+
+
+def read_stories(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def timed_load(loader):
+    gc.collect()
+    rss_before = resident_memory()
+    start = time.perf_counter()
+
+    model = loader()
+
+    return model, time.perf_counter() - start, max(resident_memory() - rss_before, 0)
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+
+    return result, time.perf_counter() - start
+
+
+def entity_f1(reference, predicted):
+    # exact match of (story, start, end, label)
+    ref = set((i, span.start, span.end, span.label) for i, spans in enumerate(reference) for span in spans)
+    pred = set((i, span.start, span.end, span.label) for i, spans in enumerate(predicted) for span in spans)
+
+    true_positive = len(ref & pred)
+    precision = true_positive / len(pred) if pred else 1.0
+    recall = true_positive / len(ref) if ref else 1.0
+
+    if precision + recall == 0:
+        return 0.0
+
+    return 2 * precision * recall / (precision + recall)
+
+
+def compare_tagger(stories, model_path, mini_batch_size):
+    results = []
+
+    tagger, load_time, memory = timed_load(lambda: SequenceTagger.load(model_path))
+    reference, latency = timed(predict_spans, stories, tagger, mini_batch_size)
+    results.append(("fp32", load_time, memory, latency, 1.0))
+
+    del tagger
+
+    tagger, load_time, memory = timed_load(lambda: quantize_dynamic_int8(SequenceTagger.load(model_path).eval()))
+    predicted, latency = timed(predict_spans, stories, tagger, mini_batch_size)
+    results.append(("int8", load_time, memory, latency, entity_f1(reference, predicted)))
+
+    return results
+
+
+def compare_encoder(stories, model_name, batch_size):
+    results = []
+
+    encoder, load_time, memory = timed_load(lambda: SentenceTransformer(model_name))
+    reference, latency = timed(encoder.encode, stories, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+    results.append(("fp32", load_time, memory, latency, 0.0, 0.0))
+
+    del encoder
+
+    encoder, load_time, memory = timed_load(lambda: quantize_dynamic_int8(SentenceTransformer(model_name)))
+    embeddings, latency = timed(encoder.encode, stories, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+
+    drift = 1 - np.sum(reference * embeddings, axis=1)
+    results.append(("int8", load_time, memory, latency, float(drift.mean()), float(drift.max())))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare int8 and fp32 NER tagger and sentence encoders")
+    parser.add_argument("stories", help="held-out user stories, one per line")
+    parser.add_argument("--ner-model", default=NER_MODEL_PATH)
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    stories = read_stories(args.stories)
+    print("{} stories".format(len(stories)))
+
+    print("\nNER tagger ({})".format(args.ner_model))
+    print("{:<6} {:>10} {:>12} {:>14} {:>10}".format("mode", "load (s)", "memory (MB)", "latency (ms)", "entity F1"))
+    for mode, load_time, memory, latency, f1 in compare_tagger(stories, args.ner_model, args.batch_size):
+        print("{:<6} {:>10.2f} {:>12.1f} {:>14.2f} {:>10.4f}".format(mode, load_time, memory / 2**20, 1000 * latency / len(stories), f1))
+
+    for model_name in ENCODERS:
+        print("\nSentence encoder ({})".format(model_name))
+        print("{:<6} {:>10} {:>12} {:>14} {:>12} {:>12}".format("mode", "load (s)", "memory (MB)", "latency (ms)", "mean drift", "max drift"))
+        for mode, load_time, memory, latency, mean_drift, max_drift in compare_encoder(stories, model_name, args.batch_size):
+            print("{:<6} {:>10.2f} {:>12.1f} {:>14.2f} {:>12.6f} {:>12.6f}".format(mode, load_time, memory / 2**20, 1000 * latency / len(stories), mean_drift, max_drift))
+
+    print("\nlatency is per story, drift is 1 - cosine(fp32, int8)")
+
+
+if __name__ == "__main__":
+    main()
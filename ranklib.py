@@ -0,0 +1,156 @@
+import argparse
+import numpy as np
+'''
+In-process scorer for the RankBoost models trained with RankLib (LTR_resources/4_RankBoost.model).
+A RankBoost model is a list of weighted weak rankers "fid:threshold:weight". A weak ranker gives 1 when the
+value of feature fid is above its threshold, 0 otherwise, and the score of a sample is the weighted sum of
+the weak rankers, added in the order of the model file.
+RankLib reads the feature values as 32 bit floats and sums the weights in double precision, the scorer does
+the same, and ties are ranked in input order like RankLib's stable merge sort, so the rankings are identical.
+
+Features are exchanged as a (n_queries x n_docs x n_features) float32 tensor with the qid of every query and
+the docid of every document (save_features / load_features, one .npz file). SVMlight text is only written
+for offline RankLib experiments:
+
+    python ranklib.py LTR_resources/ltr_<project>.npz LTR_resources/ltr_<project>.txt
+
+ranklib_check.py compares the rankings of the scorer with the -indri output of RankLib.
+'''
+
+RANKBOOST_MODEL_PATH = "LTR_resources/4_RankBoost.model"
+
+
+class RankBoostScorer(object):
+    def __init__(self, fids, thresholds, weights):
+        # fids are 1-based, like in the SVMlight files
+        self.fids = np.asarray(fids, dtype=np.int64)
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+
+        if len(self.fids) == 0:
+            raise ValueError("RankBoost model without weak rankers")
+
+        if self.fids.min() < 1:
+            raise ValueError("RankBoost feature ids start at 1")
+
+    @classmethod
+    def load(cls, path=RANKBOOST_MODEL_PATH):
+        fids, thresholds, weights = [], [], []
+
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                # "##" lines hold the training parameters
+                if len(line) == 0 or line.startswith("##"):
+                    continue
+
+                for ranker in line.split():
+                    fid, threshold, weight = ranker.split(":")
+                    fids.append(int(fid))
+                    thresholds.append(float(threshold))
+                    weights.append(float(weight))
+
+        return cls(fids, thresholds, weights)
+
+    @property
+    def n_features(self):
+        return int(self.fids.max())
+
+    def score(self, features):
+        # features is (..., n_features), e.g. (n_requirements x n_patterns x 26), returns the (...) scores
+        features = np.asarray(features)
+        if features.shape[-1] < self.n_features:
+            raise ValueError("The model uses {} features, got {}".format(self.n_features, features.shape[-1]))
+
+        features = features.astype(np.float32).astype(np.float64)
+
+        scores = np.zeros(features.shape[:-1])
+        for fid, threshold, weight in zip(self.fids, self.thresholds, self.weights):
+            scores += weight * (features[..., fid - 1] > threshold)
+
+        return scores
+
+    def rank(self, scores):
+        # indices sorting the last axis by decreasing score, ties keep their input order
+        return np.argsort(-np.asarray(scores), axis=-1, kind='stable')
+
+
+def save_features(filename, features, qids, docids):
+    np.savez(filename, features=np.asarray(features, dtype=np.float32), qids=np.asarray(qids, dtype=str), docids=np.asarray(docids, dtype=str))
+
+
+def load_features(filename):
+    # (features, qids, docids)
+    with np.load(filename) as data:
+        return data["features"], data["qids"].tolist(), data["docids"].tolist()
+
+
+def write_svmlight(filename, features, qids, docids, label=1):
+    # one line per (query, doc), written query by query: "<label> qid:<qid> 1:<v> ... #docid=<docid>"
+    # the label is not read by RankLib when ranking
+    with open(filename, "w") as f:
+        for qid, query_features in zip(qids, features):
+            for docid, values in zip(docids, query_features):
+                f.write("{} qid:{} {} #docid={}\n".format(label, qid, " ".join("{}:{}".format(j + 1, float(v)) for j, v in enumerate(values)), docid))
+
+
+def read_svmlight(filename):
+    # (features, qids, docids) of an SVMlight file, every query ranks the same documents in the same order
+    # missing features are 0, as in RankLib
+    queries = {}
+    with open(filename, "r") as f:
+        for line in f:
+            line, _, comment = line.partition("#")
+            if len(line.strip()) == 0:
+                continue
+
+            parts = line.split()
+            qid = parts[1].split(":", 1)[1]
+            values = {int(fid): float(value) for fid, value in (part.split(":") for part in parts[2:])}
+            queries.setdefault(qid, []).append((comment.strip().replace("docid=", ""), values))
+
+    if len(queries) == 0:
+        raise ValueError("No sample in {}".format(filename))
+
+    qids = list(queries)
+    docids = [docid for docid, _ in queries[qids[0]]]
+    n_features = max(max(values, default=0) for docs in queries.values() for _, values in docs)
+
+    features = np.zeros((len(qids), len(docids), n_features), dtype=np.float32)
+    for i, qid in enumerate(qids):
+        if [docid for docid, _ in queries[qid]] != docids:
+            raise ValueError("Query {} does not rank the same documents as query {}".format(qid, qids[0]))
+
+        for j, (_, values) in enumerate(queries[qid]):
+            for fid, value in values.items():
+                features[i, j, fid - 1] = value
+
+    return features, qids, docids
+
+
+def read_indri(filename):
+    # qid -> [(docid, score)] in rank order, from the -indri output of RankLib: "<qid> Q0 docid=<docid> <rank> <score> indri"
+    ranking = {}
+    with open(filename, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 5:
+                continue
+
+            ranking.setdefault(parts[0], []).append((int(parts[3]), parts[2].replace("docid=", ""), float(parts[4])))
+
+    return {qid: [(docid, score) for _, docid, score in sorted(rows)] for qid, rows in ranking.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a feature tensor (.npz) to SVMlight text for RankLib")
+    parser.add_argument("features", help=".npz written by save_features")
+    parser.add_argument("output", help="SVMlight file")
+    args = parser.parse_args()
+
+    features, qids, docids = load_features(args.features)
+    write_svmlight(args.output, features, qids, docids)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import os
+import subprocess
+import tempfile
+import numpy as np
+from ranklib import RankBoostScorer, load_features, read_svmlight, read_indri, write_svmlight
+'''
+Check that RankBoostScorer ranks like RankLib: the order of the documents of every query must be the one of
+the -indri output of RankLib, and the scores must match to the 5 decimals RankLib prints.
+
+    python ranklib_check.py
+    python ranklib_check.py --jar RankLib-2.18.jar
+    python ranklib_check.py --model LTR_resources/4_RankBoost.model --features LTR_resources/ltr_<project>.npz --indri ltr_output.txt --jar RankLib-2.18.jar
+
+Without arguments it checks the sample of ranklib_reference/: a 6 weak ranker model and 2 queries of 5
+documents, with ties, values equal to a threshold, and 0.1 and 0.3 that are only above the thresholds 0.1 and
+0.3 as 32 bit floats. sample_indri.txt was written from the RankBoost rules of RankLib (weak ranker is 1 when
+the float value is above the threshold, weights summed in model order, stable sort by decreasing score), with
+--jar it is rewritten by RankLib itself before the check:
+
+    java -jar RankLib-2.18.jar -load sample.model -rank sample.txt -indri sample_indri.txt
+
+--features takes an SVMlight file or a .npz written by save_features (LTR_SAVE_FEATURES in app.py).
+'''
+
+REFERENCE_DIR = "ranklib_reference"
+
+
+def run_ranklib(jar, model, features_file, indri):
+    # RankLib ranks the SVMlight file, the feature tensors are converted first
+    if features_file.endswith(".npz"):
+        fd, svmlight_file = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+        write_svmlight(svmlight_file, *load_features(features_file))
+    else:
+        svmlight_file = features_file
+
+    try:
+        subprocess.run(["java", "-jar", jar, "-load", model, "-rank", svmlight_file, "-indri", indri], check=True)
+    finally:
+        if svmlight_file != features_file:
+            os.remove(svmlight_file)
+
+
+def compare(scorer, features, qids, docids, ranking, decimals=5):
+    # list of the differences with the RankLib ranking, empty when the rankings are identical
+    scores = scorer.score(features)
+    order = scorer.rank(scores)
+
+    differences = []
+    for i, qid in enumerate(qids):
+        if qid not in ranking:
+            differences.append("{}: not ranked by RankLib".format(qid))
+            continue
+
+        expected = [docid for docid, _ in ranking[qid]]
+        ranked = [docids[j] for j in order[i]]
+        if ranked != expected:
+            differences.append("{}: order {} instead of {}".format(qid, " ".join(ranked), " ".join(expected)))
+
+        for docid, expected_score in ranking[qid]:
+            score = scores[i, docids.index(docid)]
+            if abs(score - expected_score) > 0.6 * 10 ** -decimals:
+                differences.append("{} {}: score {} instead of {}".format(qid, docid, round(score, decimals), expected_score))
+
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the rankings of RankBoostScorer with the -indri output of RankLib")
+    parser.add_argument("--model", default=os.path.join(REFERENCE_DIR, "sample.model"))
+    parser.add_argument("--features", default=os.path.join(REFERENCE_DIR, "sample.txt"), help="SVMlight file or .npz of save_features")
+    parser.add_argument("--indri", default=os.path.join(REFERENCE_DIR, "sample_indri.txt"), help="-indri output of RankLib")
+    parser.add_argument("--jar", help="RankLib jar, the -indri output is written by RankLib first")
+    args = parser.parse_args()
+
+    if args.jar:
+        run_ranklib(args.jar, args.model, args.features, args.indri)
+
+    if args.features.endswith(".npz"):
+        features, qids, docids = load_features(args.features)
+    else:
+        features, qids, docids = read_svmlight(args.features)
+
+    scorer = RankBoostScorer.load(args.model)
+    differences = compare(scorer, features, qids, docids, read_indri(args.indri))
+
+    for difference in differences:
+        print(difference)
+
+    print("{} queries of {} documents, {}".format(len(qids), len(docids), "{} differences".format(len(differences)) if differences else "identical rankings"))
+
+    return 1 if differences else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
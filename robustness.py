@@ -0,0 +1,92 @@
+from collections import namedtuple
+'''
+Structured robustness diagram, as produced by the ucscenario DiagramGenerator.
+The generator writes PlantUML-like lines:
+
+    actor "User" as A1
+    boundary "Login\nPage" as B1
+    control "Create account" as C1
+    entity "Account" as E1
+    A1 --> B1
+
+A RobustnessDiagram keeps the elements and the edges in the order of the lines, StoryDFD.robustToDFD
+reads them in that order (an edge is only kept when its target was declared before it).
+The generator API only returns the id of the written file, so the diagram is parsed once from that file
+(RobustnessDiagram.from_file), or built in memory with add_element / add_edge.
+'''
+
+ELEMENT_KINDS = ("actor", "boundary", "control", "entity")
+
+# kind is one of ELEMENT_KINDS, alias is the id used by the edges
+Element = namedtuple('Element', ['kind', 'alias', 'label'])
+Edge = namedtuple('Edge', ['source', 'target'])
+
+
+class RobustnessDiagram(object):
+    def __init__(self):
+        # Element and Edge, in declaration order
+        self.statements = []
+
+    def __repr__(self):
+        return "RobustnessDiagram({} elements, {} edges)".format(len(self.elements()), len(self.edges))
+
+    def add_element(self, kind, alias, label):
+        if kind not in ELEMENT_KINDS:
+            raise ValueError("Unknown element kind {}".format(kind))
+
+        self.statements.append(Element(kind, alias, label))
+
+    def add_edge(self, source, target):
+        self.statements.append(Edge(source, target))
+
+    def elements(self, kind=None):
+        return [s for s in self.statements if isinstance(s, Element) and (kind is None or s.kind == kind)]
+
+    @property
+    def actors(self):
+        return self.elements("actor")
+
+    @property
+    def boundaries(self):
+        return self.elements("boundary")
+
+    @property
+    def controls(self):
+        return self.elements("control")
+
+    @property
+    def entities(self):
+        return self.elements("entity")
+
+    @property
+    def edges(self):
+        return [s for s in self.statements if isinstance(s, Edge)]
+
+    @classmethod
+    def from_lines(cls, lines):
+        diagram = cls()
+
+        for line in lines:
+            uml_part = line.split()
+
+            # element: <kind> <label words> as <alias>
+            if len(uml_part) >= 4 and uml_part[0] in ELEMENT_KINDS and 'as' in uml_part:
+                alias_index = uml_part.index('as') + 1
+                label = ' '.join(uml_part[1:alias_index-1]).replace('"','')
+
+                # the generator writes line breaks of the labels as a literal \n, entity labels keep them
+                if uml_part[0] != 'entity':
+                    label = label.replace('\\n',' ')
+
+                diagram.add_element(uml_part[0], uml_part[alias_index], label)
+
+            # dependency: <source> <arrow> <target>
+            if len(uml_part) == 3:
+                diagram.add_edge(uml_part[0], uml_part[-1])
+
+        return diagram
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename, 'r') as ff:
+            return cls.from_lines(ff)
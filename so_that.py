@@ -1,13 +1,9 @@
-import spacy
 import re
 import os
-from flair.data import Sentence
-from flair.models import SequenceTagger
+from model_registry import get_nlp, get_so_that_ner_model, model_fingerprint
+from ner_inference import tag_stories, DEFAULT_MINI_BATCH_SIZE
 
-nlp = spacy.load("en_core_web_sm")
-
-NER_MODEL_PATH = "static/model/ner-model.pt"
-ner_model = SequenceTagger.load(NER_MODEL_PATH)
+DEFAULT_PARSE_BATCH_SIZE = 64
 
 # taken from preprocessing.py (Fabian Gilson)
 def split_us(us):
@@ -53,16 +49,97 @@ def split_us(us):
         return first.strip(),second.strip(),third.strip(), idx_cut, idx_so_that
 
 
+class StoryAnalysis(object):
+    '''
+    Everything the "so that" parser and the DFD generation need from one story,
+    computed once: the NER spans, one spaCy parse of the full story and the
+    split_us parts exposed as spans of that parse (first, second, third).
+    The parse is only run when one of the spans is needed.
+    '''
+    def __init__(self, us, doc=None, entities=None):
+        self.text = us
+        self.first_text, self.second_text, self.third_text, self.idx_cut_first, self.idx_cut_second = split_us(us)
+
+        if entities is None:
+            entities, = tag_stories([us], get_so_that_ner_model(), fingerprint=model_fingerprint("ner_so_that"))
+
+        self.entities = entities
+        self._doc = doc
+        self._segments = None
+
+    def __repr__(self):
+        return "StoryAnalysis(%r)" % self.text
+
+    @property
+    def doc(self):
+        if self._doc is None:
+            self._doc = get_nlp()(self.text)
+
+        return self._doc
+
+    @property
+    def first(self):
+        return self.segments()[0]
+
+    @property
+    def second(self):
+        return self.segments()[1]
+
+    @property
+    def third(self):
+        return self.segments()[2]
+
+    def segments(self):
+        if self._segments is None:
+            offset = 0
+            self._segments = []
+            for part in (self.first_text, self.second_text, self.third_text):
+                span, offset = self.segment(part, offset)
+                self._segments.append(span)
+
+        return self._segments
+
+    def segment(self, part, offset):
+        # span of the parse covering part, searched from the character offset
+        start = self.text.find(part, offset) if part else -1
+        if start == -1:
+            return self.doc[0:0], offset
+
+        span = self.doc.char_span(start, start + len(part), alignment_mode="expand")
+        if span is None:
+            span = self.doc[0:0]
+
+        return span, start + len(part)
+
+
+def parse_stories(stories, batch_size=DEFAULT_PARSE_BATCH_SIZE, n_process=1):
+    # bulk parsing with nlp.pipe, the docs are returned in the order of the stories
+    return list(get_nlp().pipe(stories, batch_size=batch_size, n_process=n_process))
+
+
+def analyze_stories(stories, ner_batch_size=DEFAULT_MINI_BATCH_SIZE, parse_batch_size=DEFAULT_PARSE_BATCH_SIZE, n_process=1):
+    # StoryAnalysis of many stories: one batched NER call, and one nlp.pipe over
+    # the stories with a "so that" part, the only ones process_so_that parses
+    all_entities = tag_stories(stories, get_so_that_ner_model(), ner_batch_size, model_fingerprint("ner_so_that"))
+
+    to_parse = list(dict.fromkeys(story for story in stories if split_us(story)[2]))
+    docs = dict(zip(to_parse, parse_stories(to_parse, parse_batch_size, n_process)))
+
+    return [StoryAnalysis(story, doc=docs.get(story), entities=entities) for story, entities in zip(stories, all_entities)]
+
+
 def get_compounds(doc, verbose=False):
     # original code: https://stackoverflow.com/questions/51308482/wish-to-extract-compound-noun-adjective-pairs-from-a-sentence-so-basically-i-w
+    # doc can also be a span of a parsed story, token indices always refer to the whole parse
+    start = getattr(doc, 'start', 0)
 
     compounds = [tok for tok in doc if tok.dep_ == 'compound'] # Get list of compounds in doc
-    compounds = [c for c in compounds if c.i == 0 or doc[c.i - 1].dep_ != 'compound'] # Remove middle parts of compound nouns, but avoid index errors
+    compounds = [c for c in compounds if c.i == start or c.doc[c.i - 1].dep_ != 'compound'] # Remove middle parts of compound nouns, but avoid index errors
 
     noun_list = []
     if compounds: 
         for tok in compounds:
-            noun = doc[tok.i: tok.head.i + 1]
+            noun = tok.doc[tok.i: tok.head.i + 1]
             pair_item_1 = noun
             
             if noun.root.dep_ in ['nsubj', 'nsubjpass']:
@@ -73,24 +150,26 @@ def get_compounds(doc, verbose=False):
 
     return noun_list
 
-def parse_so_that(third, processing, first_actor, second_actor):
-    doc = nlp(third)
+def parse_so_that(third, processing, first_actor, second_actor, doc=None):
+    # doc is the parse of third, usually the third span of a StoryAnalysis
+    if doc is None:
+        doc = get_nlp()(third)
 
     if third.lower().startswith("so that "):
         third = third[len("so that"):].strip()
     
     token_processing_index = 0
     if processing is None:
-        for token in doc:
+        for i, token in enumerate(doc):
             if token.pos_ == "VERB" and token.tag_ == "VB":
-                processing = str(doc[token.i:])
-                token_processing_index = token.i
+                processing = str(doc[i:])
+                token_processing_index = i
 
     # seach for negation
     # if negation appear before main VERB, just return None 
     # it is usually a non-functional requirement, which are not suitable for DFD
-    for token in doc:
-        if token.dep_ == "neg" and token.i < token_processing_index:
+    for i, token in enumerate(doc):
+        if token.dep_ == "neg" and i < token_processing_index:
             return None, None
 
     if processing is not None:
@@ -118,13 +197,13 @@ def parse_so_that(third, processing, first_actor, second_actor):
     return actors, processing
 
 
-def process_so_that(us):
-    first, second, third, idx_cut_first, idx_cut_second = split_us(us)
-
-    sentence = Sentence(us)
-    ner_model.predict(sentence)
+def process_so_that(us, analysis=None):
+    if analysis is None:
+        analysis = StoryAnalysis(us)
 
-    m = sentence.to_dict(tag_type='ner')
+    third = analysis.third_text
+    idx_cut_first, idx_cut_second = analysis.idx_cut_first, analysis.idx_cut_second
+    entities = analysis.entities
 
     # print(first, "2", second, "3" , third)
 
@@ -142,22 +221,21 @@ def process_so_that(us):
     processing_idx_in_so_that = None
 
     if len(third) > 0:
-        print(m["entities"])
-        for entity in m["entities"]:
+        print(entities)
+        for entity in entities:
             # check first actor
-            if entity["labels"][0].value == "Data" and entity["start_pos"] < idx_cut_first:
-                first_actor = entity["text"]
+            if entity.label == "Data" and entity.start < idx_cut_first:
+                first_actor = entity.text
 
             # check second actor
             if second_actor is None:
-                if entity["start_pos"] > idx_cut_first and entity["start_pos"] < idx_cut_second:
-                    for label in entity["labels"]:
-                        if label.score > 0.5 and label.value == "Data":
-                            second_actor = entity["text"]
+                if entity.start > idx_cut_first and entity.start < idx_cut_second:
+                    if entity.score > 0.5 and entity.label == "Data":
+                        second_actor = entity.text
 
             # get personal data involved
-            if entity["labels"][0].value == "PII" and entity["start_pos"] > idx_cut_second:
-                personal_data_in_so_that.append(entity["text"].capitalize())
+            if entity.label == "PII" and entity.start > idx_cut_second:
+                personal_data_in_so_that.append(entity.text.capitalize())
 
             # search for the first processing entity
             '''
@@ -178,12 +256,12 @@ def process_so_that(us):
             processing = us[processing_idx_in_so_that:]
 
         if first_actor is None:
-            first_actor = get_compounds(nlp(first))
+            first_actor = get_compounds(analysis.first)
 
         if second_actor is None:
-            second_actor = get_compounds(nlp(second))
+            second_actor = get_compounds(analysis.second)
 
-        actors, verb = parse_so_that(third, processing, first_actor, second_actor)
+        actors, verb = parse_so_that(third, processing, first_actor, second_actor, analysis.third)
 
         # if there are no verb / processing, we don't need to process it further to DFD
         if verb is not None and len(actors) > 0: